@@ -48,5 +48,24 @@ SEGMENT_END_IDX = {
     8192: 721
 }
 
+# VERSION OF THE HEADER WRITTEN TO HISTORY FILES
+HISTORY_VERSION = 1
+
 # ALPHA VALUE FOR EXPONENTIAL AVERAGING
-ALPHA = 2 / (1+12)
\ No newline at end of file
+ALPHA = 2 / (1+12)
+
+# NUMBER OF MIN/MAX BINS KEPT FOR TIME SERIES PLOTS
+ENVELOPE_POINTS = 5000
+
+# STARTUP TIME BUDGETS (SECONDS) FOR EACH ENTRY POINT
+# Conservative limits rather than measurements: time from argument parsing
+# to report_startup, which for all but prune and reset is mostly importing
+# gwpy.time. Tighten them once startup has been timed on the cluster.
+STARTUP_BUDGETS = {
+    'ligocam': 5.0,
+    'ligocam-batch': 5.0,
+    'ligocam-live': 5.0,
+    'ligocam-post': 5.0,
+    'ligocam-prune': 1.0,
+    'ligocam-reset': 1.0
+}
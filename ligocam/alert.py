@@ -15,7 +15,6 @@
 
 import os
 import subprocess
-from ConfigParser import ConfigParser
 
 __author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
 
@@ -17,11 +17,18 @@ from __future__ import division
 import numpy as np
 import os
 
-from . import plot as lcplot
 from . import utils as lcutils
+from . import classes as lcclasses
 from . import (SEGMENT_FREQS, NUM_SEGMENTS,
                SEGMENT_EDGES, SEGMENT_END_IDX)
 
+# Largest number of channels whose PSDs are stacked for one status check
+STATUS_BATCH = 64
+
+# Largest memory (bytes) of PSDs held by an hourly job for one block of
+# status checks
+STATUS_BLOCK_BYTES = 256 * 2**20
+
 #=========================================================
 
 def prep_data(freq, psd, psd_ref, duration,
@@ -112,18 +119,71 @@ def prep_data(freq, psd, psd_ref, duration,
     }
     return data_segs
 
+def check_flatline(ts, flatline_thresholds):
+    """
+    Cheap time-domain check for dead data before any spectrum is
+    computed. Returns a short description of why the data look dead,
+    or None if they do not.
+    """
+    
+    ts = np.asarray(ts)
+    n = len(ts)
+    if n == 0:
+        return 'no data'
+    nan_mask = np.isnan(ts)
+    nan_fraction = nan_mask.sum() / n
+    if nan_fraction >= flatline_thresholds['nan_fraction']:
+        return 'NaN fraction %.3g' % nan_fraction
+    zero_fraction = (ts == 0).sum() / n
+    if zero_fraction >= flatline_thresholds['zero_fraction']:
+        return 'zero fraction %.3g' % zero_fraction
+    valid = ts[~nan_mask]
+    variance = valid.var()
+    if variance <= flatline_thresholds['variance']:
+        return 'variance %.3g' % variance
+    # Longest run of identical consecutive samples
+    changes = np.flatnonzero(np.diff(ts) != 0)
+    run_edges = np.concatenate(([-1], changes, [n - 1]))
+    constant_run = np.diff(run_edges).max() / n
+    if constant_run >= flatline_thresholds['constant_run']:
+        return 'constant for %.3g of samples' % constant_run
+    return None
+
+def flatline_status(channel, disconn_file, daqfail_file):
+    """
+    Status and BLRMS results for a channel whose data failed the
+    flatline check, which is reported as a DAQ failure.
+    """
+    
+    disconn_hour = lcutils.get_alert_hour(disconn_file, channel)
+    daqfail_hour = lcutils.get_alert_hour(daqfail_file, channel) + 1
+    results = {
+        'daqfail': True,
+        'disconn': False,
+        'disconn_hour': disconn_hour,
+        'daqfail_hour': daqfail_hour,
+        'blrms_changes': [0] * 11,
+        'excess': False
+    }
+    return results
+
 def check_status(channel, psd, psd_ref, disconn_file, daqfail_file, \
-                 duration, daqfail_thresholds, disconn_thresholds):
+                 duration, daqfail_thresholds, disconn_thresholds,
+                 channel_class=None, status=None):
     """
-    Check for disconnection or DAQ failure
+    Check for disconnection or DAQ failure. status is the (disconn,
+    daqfail) pair if already found by channels_status.
     """
     
     disconn_hour = lcutils.get_alert_hour(disconn_file, channel)
     daqfail_hour = lcutils.get_alert_hour(daqfail_file, channel)
-    disconn, daqfail = channel_status(
-        channel, psd, duration,
-        daqfail_thresholds, disconn_thresholds
-    )
+    if status is None:
+        status = channel_status(
+            channel, psd, duration,
+            daqfail_thresholds, disconn_thresholds,
+            channel_class=channel_class
+        )
+    disconn, daqfail = status
     if disconn:
         disconn_hour += 1
     if daqfail_hour:
@@ -137,22 +197,27 @@ def check_status(channel, psd, psd_ref, disconn_file, daqfail_file, \
     return status_dict
 
 def check_blrms(channel, psd_binned_segs, psd_ref_binned_segs, 
-                blrms_thresholds):
+                blrms_thresholds, channel_class=None):
     """
     Compute band-limited RMS changes and determine
-    if they exceed thresholds.
+    if they exceed thresholds. Band powers are summed in double
+    precision whatever the precision of the spectra.
     """
     
+    if channel_class is None:
+        channel_class = lcclasses.classify(
+            channel, lcclasses.DEFAULT_RULES)
     blrms_dict = {}
     blrms_changes = []
     for i in range(11):
         if i < len(psd_binned_segs):
-            numer = np.sqrt(sum(psd_binned_segs[i]))
-            denom = np.sqrt(sum(psd_ref_binned_segs[i]))
+            numer = np.sqrt(np.sum(psd_binned_segs[i], dtype=np.float64))
+            denom = np.sqrt(
+                np.sum(psd_ref_binned_segs[i], dtype=np.float64))
             blrms_changes.append(numer / denom)
         else:
             blrms_changes.append(0)
-    if '_SEIS_' in channel:
+    if channel_class == 'seis':
         cond_1 = [x for x in blrms_changes[:3] if \
                   x > blrms_thresholds['greater_1'] or \
                   x < blrms_thresholds['less_1'] and x > 0]
@@ -160,7 +225,7 @@ def check_blrms(channel, psd_binned_segs, psd_ref_binned_segs,
                   x > blrms_thresholds['greater_2'] or \
                   x < blrms_thresholds['less_2'] and x > 0]
         excess = (len(cond_1) > 0 or len(cond_2) > 0)
-    elif '_ACC_' in channel or '_MIC_' in channel:
+    elif channel_class == 'acc_mic':
         cond = [x for x in blrms_changes[6:] if \
                 x > blrms_thresholds['greater_2'] or \
                 x < blrms_thresholds['less_2'] and x > 0]
@@ -177,6 +242,41 @@ def check_blrms(channel, psd_binned_segs, psd_ref_binned_segs,
                   'excess': excess}
     return blrms_dict
 
+def compare_precision(channel, freq, psds, psd_ref, duration,
+                      daqfail_thresholds, disconn_thresholds,
+                      blrms_thresholds, channel_class=None):
+    """
+    Analyze the PSDs of the same data computed in double and single
+    precision (psds), each against the reference in its own precision.
+    Returns the largest relative difference of the BLRMS ratios and the
+    names of the decisions (disconn, daqfail, excess) that differ.
+    """
+    
+    decisions = []
+    ratios = []
+    for psd in psds:
+        ref = np.asarray(psd_ref, dtype=psd.dtype)
+        data_segs = prep_data(freq, psd, ref, duration)
+        disconn, daqfail = channel_status(
+            channel, psd, duration, daqfail_thresholds, disconn_thresholds,
+            channel_class=channel_class)
+        blrms_dict = check_blrms(
+            channel, data_segs['psd_binned'], data_segs['psd_ref_binned'],
+            blrms_thresholds, channel_class=channel_class)
+        decisions.append(
+            {'disconn': disconn, 'daqfail': daqfail,
+             'excess': blrms_dict['excess']})
+        ratios.append(np.array(blrms_dict['blrms_changes'], dtype=np.float64))
+    nonzero = ratios[0] != 0
+    if np.any(nonzero):
+        max_diff = np.max(np.abs(ratios[1][nonzero] - ratios[0][nonzero]) /
+                          np.abs(ratios[0][nonzero]))
+    else:
+        max_diff = 0.
+    changed = [key for key in ['disconn', 'daqfail', 'excess']
+               if decisions[0][key] != decisions[1][key]]
+    return max_diff, changed
+
 
 
 #===================================================
@@ -195,15 +295,52 @@ def check_blrms(channel, psd_binned_segs, psd_ref_binned_segs,
 
 
 
+def band_min(psd_seg):
+    """
+    Lowest ASD in a band, along the last axis.
+    """
+    
+    return np.amin(np.sqrt(psd_seg), axis=-1)
+
+def band_max(psd_seg):
+    """
+    Highest ASD in a band, along the last axis.
+    """
+    
+    return np.amax(np.sqrt(psd_seg), axis=-1)
+
+def band_rms(psd_seg, duration):
+    """
+    RMS over a band, along the last axis.
+    """
+    
+    return np.sqrt(np.sum(psd_seg, axis=-1) * 1/duration)
+
+def status_class(channel, disconn_thresholds):
+    """
+    Class of a channel when none is given, from the weak magnetometer
+    list and the default rules.
+    """
+    
+    rules = [(lcclasses.WEAK_MAG_CLASS,
+              disconn_thresholds['weak_mag_chans'])]
+    return lcclasses.classify(channel, rules + lcclasses.DEFAULT_RULES)
+
 def channel_status(channel, psd, duration, daqfail_thresholds, \
-                   disconn_thresholds):
+                   disconn_thresholds, channel_class=None):
     """
     Check channel PSD to determine status. Different
     calculation methods are performed for the various
-    channel types and sampling rates.
+    channel classes (see classes.py) and sampling rates.
+    psd may also be a stack of PSDs of the same length from
+    channels of the same class, one per row, in which case
+    disconn and daqfail are boolean arrays with one entry per row.
     """
     
-    freq_max = len(psd) // duration
+    psd = np.asarray(psd)
+    freq_max = psd.shape[-1] // duration
+    if channel_class is None:
+        channel_class = status_class(channel, disconn_thresholds)
     
     # Special ranges for avoding with 60 Hz peaks
     # 1-80Hz
@@ -236,14 +373,13 @@ def channel_status(channel, psd, duration, daqfail_thresholds, \
     
     #### SPECIAL CASES ####
     
-    weak_mag_chans = disconn_thresholds['weak_mag_chans']
-    if any([weak_chan in channel for weak_chan in weak_mag_chans]):
-        p10_100 = psd[rng10_100]
-        p59_61 = np.sqrt(psd[rng59_61])
+    if channel_class == lcclasses.WEAK_MAG_CLASS:
+        p10_100 = psd[..., rng10_100]
+        p59_61 = psd[..., rng59_61]
         daqfail_th = daqfail_thresholds['default']
         mag_th = disconn_thresholds['magexc']
-        daqfail = (np.amin(np.sqrt(p10_100)) < daqfail_th)
-        disconn = (np.amax(p59_61) < mag_th and not daqfail)
+        daqfail = (band_min(p10_100) < daqfail_th)
+        disconn = (band_max(p59_61) < mag_th) & ~daqfail
     
     
     #### CHANNELS 128 Hz AND BELOW ####
@@ -262,38 +398,36 @@ def channel_status(channel, psd, duration, daqfail_thresholds, \
             rng = range(1 * duration, 40*duration)
             daqfail_th = daqfail_thresholds['1-40hz']
         disconn_th = disconn_thresholds[str(freq_max) + 'hz']
-        psd_seg = psd[rng]
-        daqfail = (np.amin(np.sqrt(psd_seg)) < daqfail_th)
-        disconn = (np.sqrt(sum(psd_seg) * 1/duration) < disconn_th and \
-                   not daqfail)
+        psd_seg = psd[..., rng]
+        daqfail = (band_min(psd_seg) < daqfail_th)
+        disconn = (band_rms(psd_seg, duration) < disconn_th) & ~daqfail
     
     
     #### LOW-FREQ SENSORS ####
     
-    elif '_SEIS_' in channel:
-        p_seis = psd[rng_seis]
+    elif channel_class == 'seis':
+        p_seis = psd[..., rng_seis]
         disconn_th = disconn_thresholds['seis']
         daqfail_th = daqfail_thresholds['seis']
-        daqfail = (np.amin(np.sqrt(p_seis)) < daqfail_thresholds['seis'])
-        disconn = (np.sqrt(sum(p_seis) * 1/duration) < disconn_th and \
-                   not daqfail)
-    elif '_LOWFMIC_' in channel or '_TEMPERATURE_' in channel:
-        p_lowfmictemp = psd[rng_lowfmictemp]
+        daqfail = (band_min(p_seis) < daqfail_th)
+        disconn = (band_rms(p_seis, duration) < disconn_th) & ~daqfail
+    elif channel_class == 'lowfmic_temperature':
+        p_lowfmictemp = psd[..., rng_lowfmictemp]
         disconn_th = disconn_thresholds['lowfmic_temperature']
         daqfail_th = daqfail_thresholds['lowfmic_temperature']
-        disconn = (np.sqrt(sum(p_lowfmictemp) * 1/duration) < disconn_th and \
-                   np.amin(np.sqrt(p_lowfmictemp)) > daqfail_th * 0.1)
+        disconn = (band_rms(p_lowfmictemp, duration) < disconn_th) & \
+                  (band_min(p_lowfmictemp) > daqfail_th * 0.1)
         asd = np.sqrt(p_lowfmictemp)
-        daqfail_num = sum(j < daqfail_th for j in asd)
+        daqfail_num = np.sum(asd < daqfail_th, axis=-1)
         daqfail = (daqfail_num > 5)
-    elif '_TILT_' in channel:
-        p_tilt = psd[rng_tilt]
+    elif channel_class == 'tilt':
+        p_tilt = psd[..., rng_tilt]
         disconn_th = disconn_thresholds['tilt']
         daqfail_th = daqfail_thresholds['tilt']
-        disconn = (np.sqrt(sum(p_tilt) * 1/duration) < disconn_th and \
-                   np.amin(np.sqrt(p_tilt)) > daqfail_th * 0.1)
+        disconn = (band_rms(p_tilt, duration) < disconn_th) & \
+                  (band_min(p_tilt) > daqfail_th * 0.1)
         asd = np.sqrt(p_tilt)
-        daqfail_num = sum(j < daqfail_th for j in asd)
+        daqfail_num = np.sum(asd < daqfail_th, axis=-1)
         daqfail = (daqfail_num > 5)
     
     
@@ -301,68 +435,97 @@ def channel_status(channel, psd, duration, daqfail_thresholds, \
     
     elif freq_max == 128:
         # Special case for 256hz incorrect LHO MAINSMON
-        if '_MAINSMON_' in channel:
-            p10_80 = psd[rng10_80]
-            p59_61 = psd[rng59_61]
+        if channel_class == 'mainsmon':
+            p10_80 = psd[..., rng10_80]
+            p59_61 = psd[..., rng59_61]
             disconn_th = disconn_thresholds['128hz_mainsmon']
             daqfail_th = daqfail_thresholds['default']
             mag_th = disconn_thresholds['mainsmon']
-            daqfail = (np.amin(np.sqrt(p10_80)) < daqfail_th)
-            disconn = (np.sqrt(sum(p10_80) * 1/duration) < disconn_th and \
-                       np.amax(np.sqrt(p59_61)) < mag_th and not daqfail)
+            daqfail = (band_min(p10_80) < daqfail_th)
+            disconn = (band_rms(p10_80, duration) < disconn_th) & \
+                      (band_max(p59_61) < mag_th) & ~daqfail
         else:
-            p1_80 = psd[rng1_80]
+            p1_80 = psd[..., rng1_80]
             disconn_th = disconn_thresholds[str(freq_max) + 'hz']
             daqfail_th = daqfail_thresholds['default']
-            daqfail = (np.amin(np.sqrt(p1_80)) < daqfail_th)
-            disconn = (np.sqrt(sum(p1_80) * 1/duration) < disconn_th and \
-                       not daqfail)
+            daqfail = (band_min(p1_80) < daqfail_th)
+            disconn = (band_rms(p1_80, duration) < disconn_th) & ~daqfail
     
     
     #### CHANNELS 512 Hz ####
     
     elif freq_max == 256:
-        p10_100 = psd[rng10_100]
+        p10_100 = psd[..., rng10_100]
         disconn_th = disconn_thresholds['default']
         daqfail_th = daqfail_thresholds['default']
-        daqfail = (np.amin(np.sqrt(p10_100)) < daqfail_th)
-        disconn = (np.sqrt(sum(p10_100) * 1/duration) < disconn_th and \
-                   not daqfail)
+        daqfail = (band_min(p10_100) < daqfail_th)
+        disconn = (band_rms(p10_100, duration) < disconn_th) & ~daqfail
     
     
     #### CHANNELS 1024 Hz AND OVER ####
     
     else:
-        if '_ACC_' in channel or '_MIC_' in channel:
-            p10_300 = psd[rng10_300]
+        if channel_class == 'acc_mic':
+            p10_300 = psd[..., rng10_300]
             disconn_th = disconn_thresholds['acc_mic']
             daqfail_th = daqfail_thresholds['default']
-            daqfail = (np.amin(np.sqrt(p10_300)) < daqfail_th)
-            disconn = (np.sqrt(sum(p10_300) * 1/duration) < disconn_th and \
-                       not daqfail)
-        elif '_MAG_' in channel:
-            p10_100 = psd[rng10_100]
-            p59_61 = psd[rng59_61]
+            daqfail = (band_min(p10_300) < daqfail_th)
+            disconn = (band_rms(p10_300, duration) < disconn_th) & ~daqfail
+        elif channel_class == 'mag':
+            p10_100 = psd[..., rng10_100]
+            p59_61 = psd[..., rng59_61]
             daqfail_th = daqfail_thresholds['default']
             mag_th = disconn_thresholds['mag']
-            daqfail = (np.amin(np.sqrt(p10_100)) < daqfail_th)
-            disconn = (np.amax(np.sqrt(p59_61)) < mag_th and not daqfail)
+            daqfail = (band_min(p10_100) < daqfail_th)
+            disconn = (band_max(p59_61) < mag_th) & ~daqfail
         # Mar 31, 2015 LHO made this choice.
-        elif '_MAINSMON_' in channel:
-            p10_100 = psd[rng10_100]
-            p59_61 = psd[rng59_61]
+        elif channel_class == 'mainsmon':
+            p10_100 = psd[..., rng10_100]
+            p59_61 = psd[..., rng59_61]
             disconn_th = disconn_thresholds['mag_mainsmon']
             daqfail_th = daqfail_thresholds['default']
             mag_th = disconn_thresholds['mainsmon']
-            daqfail = (np.amin(np.sqrt(p10_100)) < daqfail_th)
-            disconn = (np.sqrt(sum(p10_100) * 1/duration) < disconn_th and \
-                       np.amax(np.sqrt(p59_61)) < mag_th and not daqfail)
+            daqfail = (band_min(p10_100) < daqfail_th)
+            disconn = (band_rms(p10_100, duration) < disconn_th) & \
+                      (band_max(p59_61) < mag_th) & ~daqfail
         else:
-            p10_100 = psd[rng10_100]
+            p10_100 = psd[..., rng10_100]
             disconn_th = disconn_thresholds['default']
             daqfail_th = daqfail_thresholds['default']
-            daqfail = (np.amin(np.sqrt(p10_100)) < daqfail_th)
-            disconn = (np.sqrt(sum(p10_100) * 1/duration) < disconn_th and \
-                       not daqfail)
+            daqfail = (band_min(p10_100) < daqfail_th)
+            disconn = (band_rms(p10_100, duration) < disconn_th) & ~daqfail
+    
+    return disconn, daqfail
+
+def channels_status(channels, psds, duration, daqfail_thresholds,
+                    disconn_thresholds, classes=None,
+                    batch_size=STATUS_BATCH, dtype=np.float64):
+    """
+    Check the status of many channels at once. Channels are grouped by
+    class and PSD length, and each group is checked by channel_status
+    over stacked PSDs, batch_size channels at a time, in the precision
+    of dtype. psds is a dict of channel: PSD, classes a dict of
+    channel: class. Returns a dict of channel: (disconn, daqfail).
+    """
     
-    return disconn, daqfail
\ No newline at end of file
+    if classes is None:
+        classes = {}
+    groups = {}
+    for channel in channels:
+        channel_class = classes.get(channel)
+        if channel_class is None:
+            channel_class = status_class(channel, disconn_thresholds)
+        key = (channel_class, len(psds[channel]))
+        groups.setdefault(key, []).append(channel)
+    status = {}
+    for (channel_class, _), group in groups.items():
+        for i in range(0, len(group), batch_size):
+            batch = group[i:i + batch_size]
+            stack = np.array([psds[c] for c in batch], dtype=dtype)
+            disconn, daqfail = channel_status(
+                batch[0], stack, duration,
+                daqfail_thresholds, disconn_thresholds,
+                channel_class=channel_class)
+            for j, channel in enumerate(batch):
+                status[channel] = (bool(disconn[j]), bool(daqfail[j]))
+    return status
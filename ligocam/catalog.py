@@ -0,0 +1,130 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import sys
+import heapq
+
+from . import utils as lcutils
+from . import classes as lcclasses
+from . import frameindex as lcframeindex
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Catalog of the monitored channels, kept next to the history directory
+CATALOG_NAME = 'catalog.txt'
+
+#================================================================
+
+def get_catalog_file(hist_dir):
+    """
+    Channel catalog of the runs using a history directory.
+    """
+    
+    return os.path.join(os.path.dirname(os.path.abspath(hist_dir)),
+                        CATALOG_NAME)
+
+def parse_catalog(text):
+    """
+    Parse 'channel,rate,class,available' lines into a dict of
+    channel: (sample rate or None, class, available), raising ValueError
+    if any line is malformed.
+    """
+    
+    catalog = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        split = line.rstrip().split(',')
+        if len(split) != 4 or split[3] not in ['yes', 'no']:
+            raise ValueError("invalid channel catalog line: %s" % line)
+        rate = float(split[1]) if split[1] else None
+        catalog[split[0]] = (rate, split[2], split[3] == 'yes')
+    return catalog
+
+def read_catalog(filename):
+    """
+    Read a channel catalog, or an empty one if there is none.
+    """
+    
+    result = lcutils.read_history(filename, parser=parse_catalog)
+    if result is None:
+        return {}
+    return result[0]
+
+def refresh_catalog(filename, frame_file, channels, rules, gps):
+    """
+    Update the catalog of a list of channels from the table of contents
+    of a frame file: each channel's sample rate, whether the frame file
+    has it, and its class under the given rules. If the frame file cannot
+    be read, or has none of the channels, rates and availability are
+    carried over from the existing catalog, and channels not in it are
+    assumed available. Returns the catalog.
+    """
+    
+    old = read_catalog(filename)
+    found = None
+    if frame_file is not None:
+        try:
+            found = lcframeindex.build_index(frame_file, channels)['channels']
+        except lcframeindex.READ_ERRORS as e:
+            sys.stderr.write(
+                "warning: cannot read channels of %s (%s)\n" % (frame_file, e))
+        if found is not None and len(found) == 0:
+            found = None
+    catalog = {}
+    for channel in channels:
+        if found is None:
+            rate, _, available = old.get(channel, (None, None, True))
+        elif channel in found:
+            rate, available = float(found[channel][1]), True
+        else:
+            rate, available = None, False
+        catalog[channel] = (
+            rate, lcclasses.classify(channel, rules), available)
+    text = ''.join(
+        '%s,%s,%s,%s\n' % (
+            c, '%g' % catalog[c][0] if catalog[c][0] is not None else '',
+            catalog[c][1], 'yes' if catalog[c][2] else 'no')
+        for c in channels)
+    lcutils.write_history(
+        filename, text, gps=gps, rules=lcclasses.get_rules_hash(rules))
+    return catalog
+
+def split_channels(channels, num_jobs, catalog={}):
+    """
+    Split channels into num_jobs lists with about the same total sample
+    rate, since the time to read and analyze a channel grows with it.
+    Channels of unknown rate count as the highest known rate. Each list
+    keeps the order of the channels.
+    """
+    
+    if len(channels) == 0:
+        return []
+    rates = [catalog.get(c, (None,))[0] for c in channels]
+    known = [r for r in rates if r is not None]
+    default = max(known) if len(known) > 0 else 1.
+    weights = [r if r is not None else default for r in rates]
+    num_jobs = max(1, min(num_jobs, len(channels)))
+    # Largest channels first, each to the list with the least total so far
+    loads = [(0., j) for j in range(num_jobs)]
+    assigned = [[] for j in range(num_jobs)]
+    for i in sorted(range(len(channels)), key=lambda i: -weights[i]):
+        load, j = heapq.heappop(loads)
+        assigned[j].append(i)
+        heapq.heappush(loads, (load + weights[i], j))
+    return [[channels[i] for i in sorted(x)] for x in assigned]
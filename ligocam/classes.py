@@ -0,0 +1,118 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import hashlib
+import os
+
+from . import utils as lcutils
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Class of channels that match no rule
+DEFAULT_CLASS = 'default'
+# Class of the weak magnetometer axes in the [Weak Magnetometers] section,
+# which takes precedence over all rules
+WEAK_MAG_CLASS = 'weak_mag'
+# Rules used when the thresholds file has no [Classes] section, in order
+# of precedence: (class, substrings of the channel name)
+DEFAULT_RULES = [
+    ('seis', ['_SEIS_']),
+    ('lowfmic_temperature', ['_LOWFMIC_', '_TEMPERATURE_']),
+    ('tilt', ['_TILT_']),
+    ('acc_mic', ['_ACC_', '_MIC_']),
+    ('mag', ['_MAG_']),
+    ('mainsmon', ['_MAINSMON_'])
+]
+
+#================================================================
+
+def load_rules(thresholds):
+    """
+    Read the channel class rule table from a parsed thresholds config.
+    Rules are (class, substrings) in order of precedence, starting with
+    the weak magnetometers.
+    """
+    
+    weak_mag_chans = [
+        value for key, value in thresholds.items('Weak Magnetometers')]
+    rules = [(WEAK_MAG_CLASS, weak_mag_chans)]
+    if thresholds.has_section('Classes'):
+        for key, value in thresholds.items('Classes'):
+            rules.append(
+                (key, [x.strip() for x in value.split(',') if x.strip()]))
+    else:
+        rules += DEFAULT_RULES
+    return rules
+
+def get_rules_hash(rules):
+    """
+    Short hash of a rule table, used to invalidate cached classes.
+    """
+    
+    text = ';'.join('%s=%s' % (name, ','.join(patterns))
+                    for name, patterns in rules)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()[:16]
+
+def classify(channel, rules):
+    """
+    Class of a channel: the first rule with a substring in its name.
+    """
+    
+    for name, patterns in rules:
+        for pattern in patterns:
+            if pattern in channel:
+                return name
+    return DEFAULT_CLASS
+
+def parse_classes(text):
+    """
+    Parse 'channel,class' lines, raising ValueError if any is malformed.
+    """
+    
+    classes = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        split = line.rstrip().split(',')
+        if len(split) != 2:
+            raise ValueError("invalid channel class line: %s" % line)
+        classes[split[0]] = split[1]
+    return classes
+
+def get_classes(channels, rules, cache_file=None, update_cache=True):
+    """
+    Classify a list of channels, reusing the classes cached in cache_file
+    if it was written with the same rules and covers every channel, and
+    otherwise rewriting it (if update_cache). Returns a dict of
+    channel: class.
+    """
+    
+    rules_hash = get_rules_hash(rules)
+    if cache_file is not None:
+        cached = lcutils.read_history(cache_file, parser=parse_classes)
+        if cached is not None:
+            classes, fields = cached
+            if fields.get('rules') == rules_hash and \
+               all(c in classes for c in channels):
+                return classes
+    classes = dict((c, classify(c, rules)) for c in channels)
+    if update_cache and cache_file is not None and \
+       os.path.isdir(os.path.dirname(cache_file)):
+        text = ''.join('%s,%s\n' % (c, classes[c]) for c in channels)
+        lcutils.write_history(
+            cache_file, text, keep_previous=False, rules=rules_hash)
+    return classes
@@ -0,0 +1,159 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Seconds between checks on running jobs
+POLL_INTERVAL = 1.0
+
+#================================================================
+
+def get_command(executable, opts=[], var_opts=[], args=[]):
+    """
+    Command line of a job, with options given as (name, value) pairs in
+    the same form as glue.pipeline's add_opt and add_var_opt.
+    """
+    
+    cmd = [executable]
+    for opt, value in list(opts) + list(var_opts):
+        cmd += ['--' + opt, str(value)]
+    return cmd + [str(x) for x in args]
+
+class LocalExecutor(object):
+    """
+    Runs a graph of jobs on this machine, in place of a condor DAG.
+
+    Jobs start once all their parents have succeeded, with at most
+    workers running at a time. A job that fails or runs longer than
+    timeout seconds is retried up to retry times; if it still fails, the
+    jobs depending on it are skipped, as in a condor DAG. Background jobs,
+    which mostly wait, do not count against workers and are not subject
+    to timeout, since they wait on the other jobs. Each job's output
+    goes to <name>.out and <name>.err in log_dir.
+    """
+    
+    def __init__(self, log_dir, workers=1, timeout=None, retry=0,
+                 poll_interval=POLL_INTERVAL):
+        self.log_dir = log_dir
+        self.workers = max(1, workers)
+        self.timeout = timeout
+        self.retry = retry
+        self.poll_interval = poll_interval
+        self.nodes = OrderedDict()
+
+    def add_node(self, name, cmd, parents=[], background=False):
+        """
+        Add a job with a unique name, its command line (as a list), and
+        the names of the jobs it depends on. Returns the name.
+        """
+        
+        for parent in parents:
+            if parent not in self.nodes:
+                raise ValueError("unknown parent job %s" % parent)
+        self.nodes[name] = {'cmd': cmd, 'parents': list(parents),
+                            'background': background}
+        return name
+
+    def start(self, name, attempt):
+        """
+        Start a job, with its output appended to its log files.
+        """
+        
+        logstub = os.path.join(self.log_dir, name)
+        out = open(logstub + '.out', 'a')
+        err = open(logstub + '.err', 'a')
+        if attempt > 0:
+            for f in [out, err]:
+                f.write('\n#### retry %d ####\n' % attempt)
+                f.flush()
+        proc = subprocess.Popen(self.nodes[name]['cmd'], stdout=out,
+                                stderr=err, close_fds=True)
+        return {'proc': proc, 'start': time.time(), 'attempt': attempt,
+                'files': [out, err]}
+
+    def run(self):
+        """
+        Run every job. Returns the names of the jobs that failed and of
+        those skipped because a parent failed.
+        """
+        
+        pending = list(self.nodes.keys())
+        running = OrderedDict()
+        # Running jobs that count against workers
+        busy = set()
+        done = set()
+        failed = []
+        skipped = []
+        while len(pending) > 0 or len(running) > 0:
+            # Start jobs whose parents are all done
+            for name in list(pending):
+                parents = self.nodes[name]['parents']
+                if any(p in failed or p in skipped for p in parents):
+                    pending.remove(name)
+                    skipped.append(name)
+                    sys.stdout.write(
+                        "Skipping %s (parent failed)\n" % name)
+                elif all(p in done for p in parents) and \
+                     (self.nodes[name]['background'] or
+                      len(busy) < self.workers):
+                    pending.remove(name)
+                    running[name] = self.start(name, 0)
+                    if not self.nodes[name]['background']:
+                        busy.add(name)
+                    sys.stdout.write("Started %s\n" % name)
+            if len(running) == 0:
+                if len(pending) > 0:
+                    raise RuntimeError("job graph has a cycle")
+                break
+            time.sleep(self.poll_interval)
+            # Collect finished jobs
+            for name, state in list(running.items()):
+                proc = state['proc']
+                code = proc.poll()
+                elapsed = time.time() - state['start']
+                if code is None:
+                    if self.timeout is None or elapsed < self.timeout or \
+                       self.nodes[name]['background']:
+                        continue
+                    proc.kill()
+                    proc.wait()
+                    code = 'timeout after %d s' % elapsed
+                for f in state['files']:
+                    f.close()
+                del running[name]
+                busy.discard(name)
+                if code == 0:
+                    done.add(name)
+                    sys.stdout.write(
+                        "Finished %s in %.0f s\n" % (name, elapsed))
+                elif state['attempt'] < self.retry:
+                    sys.stdout.write(
+                        "Retrying %s (exit %s)\n" % (name, code))
+                    running[name] = self.start(name, state['attempt'] + 1)
+                    if not self.nodes[name]['background']:
+                        busy.add(name)
+                else:
+                    failed.append(name)
+                    sys.stdout.write(
+                        "Failed %s (exit %s)\n" % (name, code))
+        return failed, skipped
@@ -0,0 +1,496 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import sys
+import json
+import mmap
+import struct
+import zlib
+import numpy as np
+from contextlib import contextmanager
+
+from . import utils as lcutils
+from .staging import file_lock
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Format of the index files; older ones are rebuilt
+INDEX_VERSION = 1
+# Size of the GWF file header and of the common header of every structure
+FILE_HEADER_SIZE = 40
+STRUCT_HEADER_SIZE = 14
+# Size of the FrEndOfFile structure ending every (version 8) frame file
+END_OF_FILE_SIZE = 46
+# Structures read past a channel's FrAdcData or FrProcData to find its
+# data vector (normally the next one)
+MAX_SKIP = 64
+# numpy types of FrVect data types
+FR_VECT_TYPES = {
+    0: 'i1', 1: 'i2', 2: 'f8', 3: 'f4', 4: 'i4', 5: 'i8', 6: 'c8', 7: 'c16',
+    9: 'u2', 10: 'u4', 11: 'u8', 12: 'u1'
+}
+# FrVect compression schemes read directly; zero-suppressed vectors are
+# left to the frame library. The 0x100 bit marks little-endian data.
+COMPRESS_RAW = 0
+COMPRESS_GZIP = 1
+COMPRESS_DIFF_GZIP = 3
+COMPRESS_LITTLE_ENDIAN = 0x100
+# Errors raised by files this module cannot read (other frame versions,
+# unsupported compression, damaged files)
+READ_ERRORS = (IOError, ValueError, KeyError, struct.error, zlib.error)
+
+#================================================================
+
+class BufferReader(object):
+    """
+    Read GWF primitive types from a byte string.
+    """
+    
+    def __init__(self, buf, byteorder='<', pos=0):
+        self.buf = buf
+        self.byteorder = byteorder
+        self.pos = pos
+
+    def read(self, fmt):
+        fmt = self.byteorder + fmt
+        value = struct.unpack_from(fmt, self.buf, self.pos)[0]
+        self.pos += struct.calcsize(fmt)
+        return value
+
+    def read_array(self, dtype, count):
+        dtype = np.dtype(dtype).newbyteorder(self.byteorder)
+        value = np.frombuffer(self.buf, dtype=dtype, count=count,
+                              offset=self.pos)
+        self.pos += value.nbytes
+        return value
+
+    def read_string(self):
+        length = self.read('H')
+        value = self.buf[self.pos:self.pos + length - 1]
+        self.pos += length
+        return value.decode('ascii')
+
+    def read_pointer(self):
+        return self.read('H'), self.read('I')
+
+def read_file_header(f):
+    """
+    Check the header of an open frame file and return its byte order.
+    Only version 8 frames are read directly.
+    """
+    
+    f.seek(0)
+    header = f.read(FILE_HEADER_SIZE)
+    if len(header) < FILE_HEADER_SIZE or header[:4] != b'IGWD':
+        raise ValueError("not a frame file")
+    if bytearray(header[5:6])[0] != 8:
+        raise ValueError("unsupported frame format version")
+    if struct.unpack('<H', header[12:14])[0] == 0x1234:
+        return '<'
+    return '>'
+
+def read_struct(f, pos, byteorder):
+    """
+    Read the structure at a byte offset of a frame file. Returns its
+    class, instance, body (as a BufferReader), and the offset after it.
+    """
+    
+    f.seek(pos)
+    header = f.read(STRUCT_HEADER_SIZE)
+    if len(header) < STRUCT_HEADER_SIZE:
+        raise ValueError("truncated frame file")
+    length, _, klass, instance = struct.unpack(
+        byteorder + 'QBBI', header)
+    body = f.read(length - STRUCT_HEADER_SIZE)
+    if len(body) < length - STRUCT_HEADER_SIZE:
+        raise ValueError("truncated frame file")
+    return klass, instance, BufferReader(body, byteorder), pos + length
+
+def read_toc(f, byteorder, channels=None):
+    """
+    Read the table of contents (FrTOC) of an open frame file. Returns the
+    GPS start time and duration of each frame, and for each ADC and
+    processed channel (only those in channels, if given) its kind and the
+    byte offset of its structure in every frame.
+    """
+    
+    f.seek(0, os.SEEK_END)
+    size = f.tell()
+    f.seek(size - END_OF_FILE_SIZE + STRUCT_HEADER_SIZE + 12)
+    seek_toc = struct.unpack(byteorder + 'Q', f.read(8))[0]
+    if seek_toc == 0:
+        raise ValueError("frame file has no table of contents")
+    _, _, toc, _ = read_struct(f, size - seek_toc, byteorder)
+    toc.read('h')
+    num_frames = toc.read('I')
+    toc.read_array('u4', num_frames)
+    gps_s = toc.read_array('u4', num_frames)
+    gps_n = toc.read_array('u4', num_frames)
+    dt = toc.read_array('f8', num_frames)
+    toc.read_array('i4', num_frames)
+    toc.read_array('u4', num_frames)
+    toc.read_array('u8', 5 * num_frames)
+    num_sh = toc.read('I')
+    toc.read_array('u2', num_sh)
+    for i in range(num_sh):
+        toc.read_string()
+    num_detectors = toc.read('I')
+    for i in range(num_detectors):
+        toc.read_string()
+    toc.read_array('u8', num_detectors)
+    num_stat_types = toc.read('I')
+    for i in range(2 * num_stat_types):
+        toc.read_string()
+    toc.read_array('u4', num_stat_types)
+    num_stat = toc.read('I')
+    toc.read_array('u4', 3 * num_stat)
+    toc.read_array('u8', num_stat)
+    frames = [(int(s) + int(n) * 1e-9, float(d))
+              for s, n, d in zip(gps_s, gps_n, dt)]
+    wanted = set(channels) if channels is not None else None
+    entries = {}
+    for kind in ['adc', 'proc']:
+        num = toc.read('I')
+        names = [toc.read_string() for i in range(num)]
+        if kind == 'adc':
+            toc.read_array('u4', 2 * num)
+        positions = toc.read_array('u8', num * num_frames)
+        for i, name in enumerate(names):
+            if wanted is None or name in wanted:
+                entries[name] = (kind, [int(x) for x in positions[
+                    i * num_frames:(i + 1) * num_frames]])
+    return frames, entries
+
+def read_channel_struct(f, kind, pos, byteorder):
+    """
+    Read a channel's FrAdcData or FrProcData structure. Returns its time
+    offset, sample rate (None for processed data, where it comes from the
+    data vector), and the class and instance of its data vector.
+    """
+    
+    _, _, body, end = read_struct(f, pos, byteorder)
+    body.read_string()
+    body.read_string()
+    if kind == 'adc':
+        body.read('I')
+        body.read('I')
+        body.read('I')
+        body.read('f')
+        body.read('f')
+        body.read_string()
+        sample_rate = body.read('d')
+        time_offset = body.read('d')
+        body.read('d')
+        body.read('f')
+        body.read('H')
+    else:
+        body.read('H')
+        body.read('H')
+        sample_rate = None
+        time_offset = body.read('d')
+        body.read('d')
+        body.read('d')
+        body.read('f')
+        body.read('d')
+        body.read('d')
+        num_aux = body.read('H')
+        body.read_array('f8', num_aux)
+        for i in range(num_aux):
+            body.read_string()
+    return time_offset, sample_rate, body.read_pointer(), end
+
+def read_vect(f, pointer, pos, byteorder, header_only=False):
+    """
+    Find and decode the data vector (FrVect) a channel structure points
+    to, starting at the byte offset after it. Returns the data (None if
+    header_only) and the sample spacing.
+    """
+    
+    for i in range(MAX_SKIP):
+        klass, instance, body, pos = read_struct(f, pos, byteorder)
+        if (klass, instance) == pointer:
+            break
+    else:
+        raise ValueError("data vector not found")
+    body.read_string()
+    compress = body.read('H')
+    vect_type = body.read('H')
+    num_data = body.read('Q')
+    num_bytes = body.read('Q')
+    raw_pos = body.pos
+    body.pos += num_bytes
+    num_dim = body.read('I')
+    body.read_array('u8', num_dim)
+    dx = body.read_array('f8', num_dim)
+    if header_only:
+        return None, float(dx[0])
+    scheme = compress & 0xff
+    if vect_type not in FR_VECT_TYPES or \
+       scheme not in [COMPRESS_RAW, COMPRESS_GZIP, COMPRESS_DIFF_GZIP]:
+        raise ValueError("unsupported data vector")
+    dtype = np.dtype(FR_VECT_TYPES[vect_type])
+    if scheme == COMPRESS_DIFF_GZIP and dtype.kind not in 'iu':
+        raise ValueError("unsupported data vector")
+    if compress & COMPRESS_LITTLE_ENDIAN:
+        dtype = dtype.newbyteorder('<')
+    else:
+        dtype = dtype.newbyteorder('>')
+    raw = body.buf[raw_pos:raw_pos + num_bytes]
+    if scheme != COMPRESS_RAW:
+        raw = zlib.decompress(raw)
+    data = np.frombuffer(raw, dtype=dtype, count=num_data)
+    if scheme == COMPRESS_DIFF_GZIP:
+        data = np.cumsum(data, dtype=dtype.newbyteorder('='))
+    return data, float(dx[0])
+
+@contextmanager
+def open_frame(path, mapped=False):
+    """
+    Open a frame file for reading, as a read-only memory map if mapped.
+    Staged local copies are mapped, so jobs on a node reading the same
+    file share its pages.
+    """
+    
+    f = open(path, 'rb')
+    try:
+        if mapped and os.path.getsize(path) > 0:
+            m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                yield m
+            finally:
+                m.close()
+        else:
+            yield f
+    finally:
+        f.close()
+
+def build_index(frame_file, channels):
+    """
+    Index a frame file: the start time and duration of its frames, and
+    for each of the given channels it holds, its kind, sample rate, and
+    the byte offset of its data in every frame.
+    """
+    
+    with open(frame_file, 'rb') as f:
+        byteorder = read_file_header(f)
+        frames, entries = read_toc(f, byteorder, channels)
+        index_channels = {}
+        for name, (kind, positions) in entries.items():
+            _, sample_rate, pointer, end = read_channel_struct(
+                f, kind, positions[0], byteorder)
+            if sample_rate is None:
+                sample_rate = 1. / read_vect(
+                    f, pointer, end, byteorder, header_only=True)[1]
+            index_channels[name] = [kind, sample_rate, positions]
+    return {
+        'version': INDEX_VERSION,
+        'size': os.path.getsize(frame_file),
+        'byteorder': byteorder,
+        'frames': frames,
+        'requested': sorted(set(channels)),
+        'channels': index_channels
+    }
+
+def get_index_file(index_dir, frame_file):
+    """
+    Index file of a frame file, named after it so that every job and
+    every hour reading the file share it.
+    """
+    
+    return os.path.join(index_dir, os.path.basename(frame_file) + '.json')
+
+def load_index(index_file, frame_file):
+    """
+    Load a frame file's index, or None if it is missing, outdated, or was
+    made for a different file of the same name.
+    """
+    
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+    if index.get('version') != INDEX_VERSION or \
+       index.get('size') != os.path.getsize(frame_file):
+        return None
+    return index
+
+def get_index(index_dir, frame_file, channels, name=None):
+    """
+    Load a frame file's index, building it first if needed. The index is
+    rebuilt if it does not cover all of channels. name is the file's
+    original path if frame_file is a staged copy.
+    """
+    
+    index_file = get_index_file(index_dir, name or frame_file)
+    index = load_index(index_file, frame_file)
+    if index is not None and set(channels) <= set(index['requested']):
+        return index
+    if not os.path.isdir(index_dir):
+        os.makedirs(index_dir)
+    with file_lock(index_file + '.lock'):
+        # Another job may have built it while we waited
+        index = load_index(index_file, frame_file)
+        if index is not None and set(channels) <= set(index['requested']):
+            return index
+        if index is not None:
+            channels = set(channels) | set(index['requested'])
+        index = build_index(frame_file, channels)
+        with lcutils.atomic_open(index_file) as f:
+            json.dump(index, f)
+    return index
+
+class IndexedFrameCache(object):
+    """
+    Frame cache reading channels straight from their byte offsets in the
+    frame files, as recorded in per-file indexes in index_dir.
+
+    Each frame file's table of contents is read once, by the first job
+    that needs it, and the offsets and sample rates of the monitored
+    channels are saved for every later job and reference hour reading
+    the same file. Data vectors are read with a single seek, from a
+    memory map of the file if it is a staged copy. Vectors the direct
+    reader does not decode (zero-suppressed integers, non-version 8
+    frames) are fetched through the frame library instead.
+
+    With validate, every direct read is also made through the frame
+    library and the two are compared, to check the reader against the
+    frame files in use.
+    """
+    
+    def __init__(self, cache_file, index_dir, channels, stager=None,
+                 validate=False):
+        self.cache_file = cache_file
+        self.index_dir = index_dir
+        self.channels = channels
+        self.stager = stager
+        self.validate = validate
+        self.fallback = lcutils.LazyFrameCache(cache_file, stager=stager)
+        self.indexes = {}
+        self._entries = None
+        # Channels read through the frame library instead
+        self.fallback_channels = set()
+        # Channels checked against the frame library: True if all their
+        # direct reads matched it exactly
+        self.checks = {}
+
+    @property
+    def entries(self):
+        """
+        Frame files of the cache as (start, end, path, original path).
+        """
+        
+        if self._entries is None:
+            from glue import lal
+            with open(self.cache_file, 'r') as cache:
+                lines = [x.rstrip('\n') for x in cache.readlines()]
+            self._entries = []
+            for line in lines:
+                if not line.strip():
+                    continue
+                entry = lal.CacheEntry(line)
+                path = entry.path
+                if self.stager is not None:
+                    path = lal.CacheEntry(
+                        self.stager.stage_cache_line(line)).path
+                self._entries.append((
+                    float(entry.segment[0]), float(entry.segment[1]),
+                    path, entry.path))
+            self._entries.sort()
+        return self._entries
+
+    def get_index(self, path, name, channel):
+        """
+        Index of one of the cache's frame files covering channel, kept
+        for later fetches.
+        """
+        
+        index = self.indexes.get(path)
+        if index is None or channel not in index['requested']:
+            index = get_index(
+                self.index_dir, path, list(self.channels) + [channel], name)
+            self.indexes[path] = index
+        return index
+
+    def fetch_direct(self, channel, start, end):
+        """
+        Read a channel from the frame files using their indexes.
+        """
+        
+        chunks = []
+        sample_rate = None
+        for file_start, file_end, path, name in self.entries:
+            if file_end <= start or file_start >= end:
+                continue
+            index = self.get_index(path, name, channel)
+            if channel not in index['channels']:
+                raise KeyError(channel)
+            kind, sample_rate, positions = index['channels'][channel]
+            byteorder = str(index['byteorder'])
+            with open_frame(path, mapped=(path != name)) as f:
+                for (t0, dt), pos in zip(index['frames'], positions):
+                    if t0 + dt <= start or t0 >= end:
+                        continue
+                    offset, _, pointer, pos = read_channel_struct(
+                        f, kind, pos, byteorder)
+                    data, _ = read_vect(f, pointer, pos, byteorder)
+                    t0 += offset
+                    i0 = int(round((max(start, t0) - t0) * sample_rate))
+                    i1 = int(round((min(end, t0 + dt) - t0) * sample_rate))
+                    chunks.append(data[i0:i1])
+        if sample_rate is None:
+            raise KeyError(channel)
+        x = np.concatenate(chunks).astype(np.float64)
+        if len(x) != int(round((end - start) * sample_rate)):
+            raise ValueError("gap in frame data for %s" % channel)
+        return x
+
+    def fetch(self, channel, start, end):
+        """
+        Read a channel between start and end. If the direct reader fails
+        with one of READ_ERRORS (an unsupported compression scheme, such
+        as the zero-suppressed schemes 5 and 8, another frame version, a
+        damaged or incomplete file), the whole span is read again through
+        the frame library with a LazyFrameCache of the same cache file,
+        with a warning the first time for each channel. With validate,
+        a direct read that differs from the frame library is reported
+        and the library's data are returned.
+        """
+        
+        try:
+            x = self.fetch_direct(channel, start, end)
+        except READ_ERRORS as e:
+            if channel not in self.fallback_channels:
+                sys.stderr.write(
+                    "warning: reading %s through the frame library (%s)\n"
+                    % (channel, e))
+                self.fallback_channels.add(channel)
+            return self.fallback.fetch(channel, start, end)
+        if not self.validate:
+            return x
+        y = self.fallback.fetch(channel, start, end)
+        match = (len(x) == len(y) and np.array_equal(x, np.asarray(y)))
+        self.checks[channel] = self.checks.get(channel, True) and match
+        if not match:
+            sys.stderr.write(
+                "warning: indexed read of %s differs from the frame "
+                "library\n" % channel)
+            return y
+        return x
@@ -15,25 +15,65 @@
 
 """ This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
 
-from optparse import OptionParser
 import os
 import shutil
-from gwpy.time import from_gps
 
 from . import htmllib
+from . import classes as lcclasses
 
 __author__ = 'Dipongkar Talukder <dipongkar.talukder@ligo.org>'
 
 
 # CHANNEL MAP ON PEM.LIGO.ORG
 PEM_MAP_URL = "http://pem.ligo.org/channelinfo/index.php"
+# Status page of channels with no results
+EMPTY_MESSAGE = 'No data or not enough data to determine the status.'
 
 #========================================================
 
+def get_image_urls(results, asd_path, ts_path, image_root=None,
+                   render_url=None):
+    """
+    URLs of a channel's ASD and TS plots. If the results name the image
+    directory of the plots (which may be reused from an earlier hour),
+    the URLs point to the plots rendered on demand by render_url if it is
+    given, or else to that directory under image_root. Otherwise they
+    point to asd_path and ts_path.
+    """
+    
+    chan_file = results[0].replace(':', '_') + '.png'
+    image_dir = results[18] if len(results) > 18 else None
+    if render_url is not None and image_dir:
+        sep = '&' if '?' in render_url else '?'
+        query = '%s%simage=%s&channel=%s&kind=' % (
+            render_url, sep, image_dir, results[0].replace(':', '%3A'))
+        asd_url = query + 'ASD'
+        ts_url = query + 'TS'
+    elif image_root is not None and image_dir:
+        asd_url = os.path.join(image_root, 'ASD', image_dir, chan_file)
+        ts_url = os.path.join(image_root, 'TS', image_dir, chan_file)
+    else:
+        asd_url = os.path.join(asd_path, chan_file)
+        ts_url = os.path.join(ts_path, chan_file)
+    return asd_url, ts_url
+
+def get_class(chan, classes):
+    """
+    Class of a channel from a dict of precomputed classes, or None if
+    it has to be worked out from the channel name.
+    """
+    
+    if classes is None:
+        return None
+    return classes.get(chan)
+
 def create_html(filename, results_file, ifo, subsystem, current_utc,
-                asd_path, ts_path, blrms_thresholds, pem_map_url=PEM_MAP_URL):
+                asd_path, ts_path, blrms_thresholds, pem_map_url=PEM_MAP_URL,
+                image_root=None, render_url=None, classes=None, partial=None):
     """
-    Create HTML results page for a full LigoCAM run.
+    Create HTML results page for a full LigoCAM run. If the run is still
+    going, partial is the number of channels with results so far and the
+    total, shown at the top of the page.
     """
     
     # Begin HTML table
@@ -67,22 +107,29 @@ def create_html(filename, results_file, ifo, subsystem, current_utc,
         results = line.rstrip().split(',')
         chan = results[0]
         chan_url = chan.replace(':', '%3A').rstrip('_DQ')
-        chan_file = chan.replace(':', '_') + '.png'
         info_url = "%s?channelname=%s" % (pem_map_url, chan_url)
-        asd_url = os.path.join(asd_path, chan_file)
-        ts_url = os.path.join(ts_path, chan_file)
+        asd_url, ts_url = get_image_urls(
+            results, asd_path, ts_path, image_root=image_root,
+            render_url=render_url)
         row = create_html_row(
-            results, asd_url, ts_url, blrms_thresholds, info_url=info_url)
+            results, asd_url, ts_url, blrms_thresholds, info_url=info_url,
+            channel_class=get_class(chan, classes))
         table.rows.append(row)
     
     # Write HTML page to file
-    html = table_to_html(table, ifo, subsystem, current_utc)
+    if partial is not None:
+        note = 'Partial results: %d of %d channels, jobs still running' % \
+               tuple(partial)
+    else:
+        note = None
+    html = table_to_html(table, ifo, subsystem, current_utc, note=note)
     with open(filename, 'w') as f:
         f.write(html)
     return
 
 def create_single_htmls(save_dir, results_file, ifo, subsystem,
-                        current_utc, asd_path, ts_path, blrms_thresholds):
+                        current_utc, asd_path, ts_path, blrms_thresholds,
+                        image_root=None, render_url=None, classes=None):
     """
     Creat HTML result page for a single channel's LigoCAM status.
     """
@@ -94,9 +141,12 @@ def create_single_htmls(save_dir, results_file, ifo, subsystem,
         chan = results[0]
         chan_url = chan.replace(':', '%3A').rstrip('_DQ')
         chan_file = chan.replace(':', '_')
-        asd_url = os.path.join(asd_path, chan_file + '.png')
-        ts_url = os.path.join(ts_path, chan_file + '.png')
-        row = create_html_row(results, asd_url, ts_url, blrms_thresholds)
+        asd_url, ts_url = get_image_urls(
+            results, asd_path, ts_path, image_root=image_root,
+            render_url=render_url)
+        row = create_html_row(
+            results, asd_url, ts_url, blrms_thresholds,
+            channel_class=get_class(chan, classes))
         table = htmllib.Table(
             header_row=[
                 htmllib.TableCell('Channel name', width='31%', header=True),
@@ -125,12 +175,15 @@ def create_single_htmls(save_dir, results_file, ifo, subsystem,
             f.write(html)
     return
 
-def create_html_row(results, asd_url, ts_url, blrms_thresholds, info_url=None):
+def create_html_row(results, asd_url, ts_url, blrms_thresholds, info_url=None,
+                    channel_class=None):
     """
     Create an HTML table row from a list of results for a single channel.
     """
     
     chan = results[0]
+    if channel_class is None:
+        channel_class = lcclasses.classify(chan, lcclasses.DEFAULT_RULES)
     blrms = [float(x) for x in results[1:12]]
     excess = results[12]
     daqfail = results[13]
@@ -186,7 +239,7 @@ def create_html_row(results, asd_url, ts_url, blrms_thresholds, info_url=None):
     for i, x in enumerate(blrms):
         if i < 3:
             if x > thd1g or (x < thd1l and x != 0):
-                if '_ACC_' in chan or '_MIC_' in chan:
+                if channel_class == 'acc_mic':
                     blrms_cells.append(
                         htmllib.TableCell(x, bgcolor='E8E8E8', width='4%'))
                 else:
@@ -200,8 +253,8 @@ def create_html_row(results, asd_url, ts_url, blrms_thresholds, info_url=None):
                     htmllib.TableCell(x, bgcolor='white', width='4%'))
         else:
             if x > thd2g or (x < thd2l and x != 0):
-                if (i < 5) and ('_ACC_' in chan or '_MIC_' in chan) or\
-                   (i > 5) and ('_SEIS_' in chan):
+                if (i < 5) and (channel_class == 'acc_mic') or\
+                   (i > 5) and (channel_class == 'seis'):
                     blrms_cells.append(
                         htmllib.TableCell(x, bgcolor='E8E8E8', width='4%'))
                 else:
@@ -227,9 +280,10 @@ def create_html_row(results, asd_url, ts_url, blrms_thresholds, info_url=None):
         ] + blrms_cells + [cells['image']]
     return row
 
-def table_to_html(table, ifo, subsystem, current_utc):
+def table_to_html(table, ifo, subsystem, current_utc, note=None):
     """
-    Create an HTML table from an html.Table object.
+    Create an HTML table from an html.Table object, with an optional note
+    below the epoch.
     """
     
     title = 'LigoCAM @ %s | %s' % (ifo, subsystem)
@@ -249,6 +303,10 @@ def table_to_html(table, ifo, subsystem, current_utc):
     html += '        <p align="center" style="background-color:white;color:black;'
     html += ' font-size:20px;margin-top:4px;margin-bottom:4px;">\n'
     html += 'Epoch: %s </p>\n' % current_utc
+    if note is not None:
+        html += '        <p align="center" style="background-color:#FFFF00;'
+        html += 'color:black;font-size:16px;margin-top:4px;margin-bottom:4px;">\n'
+        html += '%s </p>\n' % note
     html += '        <table class="">\n'
     html += '        <thead>\n'
     html += str(table)
@@ -261,14 +319,10 @@ def table_to_html(table, ifo, subsystem, current_utc):
     html += '</html>'
     return html
 
-def create_empty_html(filename, results_file, channel):
+def create_empty_html(filename, message=EMPTY_MESSAGE):
     """
     Create an empty HTML page for channels with no results.
     """
     
-    channel = channel.rstrip()
-    if channel not in open(results_file).read():
-        with open(filename, 'w') as status_err:
-            status_err.write(
-                'No data or not enough data to determine the status.')
-    return
\ No newline at end of file
+    with open(filename, 'w') as status_err:
+        status_err.write(message)
@@ -0,0 +1,168 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+from __future__ import division
+import os
+import numpy as np
+
+from . import utils as lcutils
+from .streaming import onesided_psd
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Default length (seconds) of each live update
+LIVE_STRIDE = 64
+# Default delay (seconds) behind real time, to let frames be written
+LIVE_LATENCY = 120
+
+#================================================================
+
+class RunningPSD(object):
+    """
+    Running average of the PSDs of a channel's strides.
+
+    Each stride is Hann-windowed and transformed on its own, and its
+    spectrum is averaged into a single spectrum at the stride's own
+    1/stride frequency resolution: a plain mean over the first
+    num_strides strides, then an exponential average with weight
+    1/num_strides, so the average spans about num_strides * stride
+    seconds. Only that one spectrum is kept, whatever num_strides is.
+    """
+    
+    def __init__(self, sample_rate, stride, num_strides):
+        self.sample_rate = int(sample_rate)
+        self.stride = stride
+        self.num_strides = num_strides
+        nbins = int(self.sample_rate * stride) // 2 + 1
+        self.psd = np.zeros(nbins, dtype=np.float32)
+        self.count = 0
+        self.last_gps = 0
+        # Status as of the last update, and the GPS time it began
+        self.disconn = False
+        self.daqfail = False
+        self.disconn_since = 0
+        self.daqfail_since = 0
+
+    def update(self, x, gps):
+        """
+        Add the spectrum of one stride of data starting at gps.
+        """
+        
+        x = np.asarray(x, dtype=np.float64)
+        psd = onesided_psd(x, self.sample_rate, np.hanning(len(x)))
+        weight = 1. / min(self.count + 1, self.num_strides)
+        self.psd += (weight * (psd[:len(self.psd)] - self.psd)).astype(
+            np.float32)
+        self.count += 1
+        self.last_gps = gps
+
+    def is_full(self):
+        """
+        Check if the average covers a full window of strides.
+        """
+        
+        return self.count >= self.num_strides
+
+    def last_time(self):
+        """
+        GPS start time of the most recent stride, or 0 if there is none.
+        """
+        
+        return int(self.last_gps)
+
+    def get_psd(self, duration=None):
+        """
+        The running average and its frequencies, at the 1/stride
+        resolution it is kept at, or interpolated onto the 1/duration
+        grid of the hourly analysis if duration is given.
+        """
+        
+        if self.count == 0:
+            raise ValueError("no strides in running PSD")
+        psd = self.psd.astype(np.float64)
+        freq = np.arange(len(psd)) / self.stride
+        if duration is None:
+            return psd, freq
+        n = int(self.sample_rate * duration)
+        grid = np.arange(n // 2 + 1) / duration
+        return np.interp(grid, freq, psd), grid
+
+    def set_status(self, disconn, daqfail, gps):
+        """
+        Record a new status, returning True if it differs from the last.
+        """
+        
+        if disconn and not self.disconn:
+            self.disconn_since = gps
+        if daqfail and not self.daqfail:
+            self.daqfail_since = gps
+        changed = (disconn != self.disconn or daqfail != self.daqfail)
+        self.disconn = disconn
+        self.daqfail = daqfail
+        return changed
+
+    def alert_hours(self, gps):
+        """
+        Hours since the current disconnection and DAQ failure began.
+        """
+        
+        disconn_hour = (gps - self.disconn_since) / 3600 \
+            if self.disconn else 0
+        daqfail_hour = (gps - self.daqfail_since) / 3600 \
+            if self.daqfail else 0
+        return disconn_hour, daqfail_hour
+
+    def save(self, filename):
+        """
+        Save the running state to an npz file, atomically.
+        """
+        
+        with lcutils.atomic_open(filename, 'wb') as f:
+            np.savez(
+                f, sample_rate=self.sample_rate, stride=self.stride,
+                num_strides=self.num_strides, psd=self.psd,
+                count=self.count, last_gps=self.last_gps,
+                status=np.array([self.disconn, self.daqfail]),
+                since=np.array([self.disconn_since, self.daqfail_since]))
+
+def load_running_psd(filename, sample_rate, stride, num_strides):
+    """
+    Load a channel's running state, or start a new one if there is none
+    or it was made with a different sample rate, stride, or window
+    (or by an older version that kept a ring of strides).
+    """
+    
+    running = RunningPSD(sample_rate, stride, num_strides)
+    if not os.path.exists(filename):
+        return running
+    try:
+        data = np.load(filename)
+        compatible = (int(data['sample_rate']) == running.sample_rate and
+                      float(data['stride']) == stride and
+                      int(data['num_strides']) == num_strides and
+                      data['psd'].shape == running.psd.shape)
+        if not compatible:
+            return running
+        running.psd = data['psd']
+        running.count = int(data['count'])
+        running.last_gps = int(data['last_gps'])
+        running.disconn, running.daqfail = [bool(x) for x in data['status']]
+        running.disconn_since, running.daqfail_since = [
+            int(x) for x in data['since']]
+    except (IOError, ValueError, KeyError):
+        return RunningPSD(sample_rate, stride, num_strides)
+    return running
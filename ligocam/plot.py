@@ -14,35 +14,135 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division
-import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
 import numpy as np
 import os
 
-def timeseries_plot(channel, filename, data, duration, current_utc):
+# Frequency range (Hz) of each ASD panel, and the unbinned segments
+# drawn in it
+ASD_PANELS = [((0.03, 3), slice(0, 4)),
+              ((3, 300), slice(4, 8)),
+              ((300, 10000), slice(8, None))]
+# Log-spaced columns the unbinned spectrum is reduced to in each panel,
+# more than the panel is wide in pixels
+REDUCE_COLUMNS = 1000
+
+def reduce_spectrum(freq, x, fmin, fmax, num_columns=REDUCE_COLUMNS):
+    """
+    Reduce a spectrum to the minimum and maximum of its bins in each of
+    num_columns log-spaced columns from fmin to fmax, so that a plot of
+    it shows the same lines and peaks as the full spectrum. Returns the
+    frequencies and values of a min/max envelope: two points per column
+    with bins in it, at the mean frequency of those bins.
+    """
+    
+    freq = np.asarray(freq)
+    x = np.asarray(x)
+    keep = (freq >= fmin) & (freq <= fmax)
+    freq = freq[keep]
+    x = x[keep]
+    if len(freq) == 0:
+        return freq, x
+    edges = np.logspace(np.log10(fmin), np.log10(fmax), num_columns + 1)
+    columns = np.clip(
+        np.searchsorted(edges, freq, side='right') - 1, 0, num_columns - 1)
+    # Frequencies are increasing, so each column is a run of bins
+    starts = np.flatnonzero(np.r_[True, columns[1:] != columns[:-1]])
+    counts = np.diff(np.r_[starts, len(freq)])
+    freq_mean = np.add.reduceat(freq, starts) / counts
+    x_min = np.minimum.reduceat(x, starts)
+    x_max = np.maximum.reduceat(x, starts)
+    return (np.repeat(freq_mean, 2).astype(freq.dtype),
+            np.column_stack((x_min, x_max)).ravel())
+
+def reduce_segments(freq_segs, x_segs, num_columns=REDUCE_COLUMNS):
+    """
+    Reduce the unbinned spectrum segments drawn in each ASD panel (see
+    reduce_spectrum). Returns lists of frequencies and values, one per
+    panel.
+    """
+    
+    freq_panels = []
+    x_panels = []
+    for (fmin, fmax), segs in ASD_PANELS:
+        reduced = [reduce_spectrum(f, x, fmin, fmax, num_columns)
+                   for f, x in zip(freq_segs[segs], x_segs[segs])]
+        if len(reduced) == 0:
+            freq_panels.append(np.zeros(0))
+            x_panels.append(np.zeros(0))
+            continue
+        freq_panels.append(np.concatenate([f for f, _ in reduced]))
+        x_panels.append(np.concatenate([x for _, x in reduced]))
+    return freq_panels, x_panels
+
+def get_pyplot():
+    """
+    Import pyplot with the non-interactive Agg backend. Matplotlib is
+    only loaded the first time a plot is made.
+    """
+    
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def placeholder_plot(channel, filename, message, current_utc):
+    """
+    Small text-only image used in place of the spectrum and time series
+    plots of channels with dead data.
+    """
+    
+    plt = get_pyplot()
+    fig = plt.figure(figsize=(6, 2))
+    fig.text(0.5, 0.5,
+             'Epoch: %s\nChannel: %s\n%s' % (current_utc, channel, message),
+             ha='center', va='center', fontsize=10)
+    fig.savefig(filename, dpi=60)
+    plt.close(fig)
+
+def timeseries_plot(channel, filename, ts_reduced, current_utc):
     """
     Plot current time series for three different time ranges.
+    
+    Parameters
+    ----------
+    channel : str
+        Channel name.
+    filename : str
+        Plot filename.
+    ts_reduced : dict
+        Reduced time series from utils.reduce_timeseries.
+    current_utc : str
+        UTC start time of current data.
     """
     
-    sample_rate = len(data) // duration
-    time = np.linspace(0, duration, len(data))
+    plt = get_pyplot()
+    sample_rate = ts_reduced['sample_rate']
+    duration = ts_reduced['duration']
     fig = plt.figure(figsize=(10,8))
     plt.suptitle('Epoch: ' + current_utc + '\nChannel: ' + channel, fontsize=14)
     
-    # 500 second time series plot
+    # 500 second time series plot (min/max envelope)
     plt.subplot(311)
-    t_ranges = []
-    t_step = 1 + len(data) // 1e5
-    plt.plot(time[::t_step], data[::t_step], 'green')
+    env_time = np.repeat(ts_reduced['envelope_time'], 2)
+    env_data = np.column_stack((ts_reduced['envelope_min'],
+                                ts_reduced['envelope_max'])).ravel()
+    plt.plot(env_time, env_data, 'green')
     plt.xlim([0, duration])
     plt.grid(True)
-    plt.xticks(range(0, duration, 100))
+    # 1, 2 or 5 times a power of ten apart, with at least five ticks
+    # (100 s for the hourly 512 s, 10 s for 64 s live strides)
+    step = 10 ** max(0, int(np.floor(np.log10(duration / 5.))))
+    for m in [5, 2]:
+        if duration // (m * step) >= 5:
+            step *= m
+            break
+    plt.xticks(range(0, duration, step))
     
     # 1 second time series plot (start)
     plt.subplot(312)
-    rng = range(0, sample_rate+1)
-    plt.plot(time[rng], data[rng], 'green')
+    data = ts_reduced['start']
+    time = np.arange(len(data)) / sample_rate
+    plt.plot(time, data, 'green')
     plt.grid(True)
     plt.xlim([0, 1])
     plt.xticks([0, 0.5, 1])
@@ -50,8 +150,9 @@ def timeseries_plot(channel, filename, data, duration, current_utc):
     
     # 1 second time series plot (end)
     plt.subplot(313)
-    rng = range(len(data) - 1*sample_rate - 1, len(data))
-    plt.plot(time[rng], data[rng], 'green')
+    data = ts_reduced['end']
+    time = duration - np.arange(len(data))[::-1] / sample_rate
+    plt.plot(time, data, 'green')
     plt.xlim([duration-1, duration])
     plt.xticks([duration - 1, duration - 0.5, duration])
     plt.xlabel('Time [s]', fontsize=14)
@@ -63,10 +164,12 @@ def timeseries_plot(channel, filename, data, duration, current_utc):
     return
 
 def asd_plot(channel, filename, freq_segs, freq_binned_segs, asd_segs,
-             asd_binned_segs, asd_binned_ref_segs, current_utc):
+             asd_binned_segs, asd_binned_ref_segs, current_utc,
+             reduced=False):
     """
     Plot ASDs for three different frequency ranges, showing current
-    and reference ASDs.
+    and reference ASDs. The unbinned ASD is drawn as the min/max envelope
+    of its log-spaced columns (see reduce_spectrum).
     
     Parameters
     ----------
@@ -86,9 +189,17 @@ def asd_plot(channel, filename, freq_segs, freq_binned_segs, asd_segs,
         Binned reference ASD segments.
     current_utc : str
         UTC start time of current data.
+    reduced : bool
+        Whether freq_segs and asd_segs are already reduced, one per
+        panel, by reduce_segments.
     """
     
-    num_segs = len(freq_segs)
+    plt = get_pyplot()
+    from matplotlib.lines import Line2D
+    if reduced:
+        freq_panels, asd_panels = freq_segs, asd_segs
+    else:
+        freq_panels, asd_panels = reduce_segments(freq_segs, asd_segs)
     num_binned_segs = len(freq_binned_segs)
     
     fig = plt.figure(figsize=(10,8))
@@ -96,12 +207,7 @@ def asd_plot(channel, filename, freq_segs, freq_binned_segs, asd_segs,
     
     # 0.3 TO 3 HZ ASD
     plt.subplot(311)
-    plt.loglog(
-        freq_segs[0], asd_segs[0], 'red',
-        freq_segs[0], asd_segs[0], 'blue'
-    )
-    for i in range(4):
-        plt.loglog(freq_segs[i], asd_segs[i], 'LightBlue')
+    plt.loglog(freq_panels[0], asd_panels[0], 'LightBlue')
     plt.loglog(
         np.concatenate(freq_binned_segs[:4]),
         np.concatenate(asd_binned_ref_segs[:4]),
@@ -113,8 +219,8 @@ def asd_plot(channel, filename, freq_segs, freq_binned_segs, asd_segs,
     plt.xlim([0.03, 3])
     plt.xticks([0.03, 0.1, 0.3, 1, 3], ['0.03', '0.1', '0.3', '1', '3'])
     plt.grid(True)
-    legend_lines = [matplotlib.lines.Line2D([0], [0], color='red'),
-                    matplotlib.lines.Line2D([0], [0], color='blue')]
+    legend_lines = [Line2D([0], [0], color='red'),
+                    Line2D([0], [0], color='blue')]
     leg = plt.legend(legend_lines, ['Reference', 'Current'], 
                      loc='lower left', shadow=False, fancybox=False)
     leg.get_frame().set_alpha(0.5)
@@ -123,8 +229,7 @@ def asd_plot(channel, filename, freq_segs, freq_binned_segs, asd_segs,
     plt.subplot(312)
     if num_binned_segs > 4:
         upper_idx = min([8, num_binned_segs])
-        for i in range(4, upper_idx):
-            plt.loglog(freq_segs[i], asd_segs[i], 'LightBlue')
+        plt.loglog(freq_panels[1], asd_panels[1], 'LightBlue')
         plt.loglog(
             np.concatenate(freq_binned_segs[4:upper_idx]),
             np.concatenate(asd_binned_ref_segs[4:upper_idx]),
@@ -143,8 +248,7 @@ def asd_plot(channel, filename, freq_segs, freq_binned_segs, asd_segs,
     # 300 TO 10K HZ ASD
     plt.subplot(313)
     if num_binned_segs > 8:
-        for i in range(8, num_binned_segs):
-            plt.loglog(freq_segs[i][::10], asd_segs[i][::10], 'LightBlue')
+        plt.loglog(freq_panels[2], asd_panels[2], 'LightBlue')
         plt.plot(
             np.concatenate(freq_binned_segs[8:num_binned_segs]),
             np.concatenate(asd_binned_ref_segs[8:num_binned_segs]),
@@ -0,0 +1,133 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import threading
+import traceback
+from collections import deque
+
+import numpy as np
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+#================================================================
+
+def get_nbytes(data):
+    """
+    Estimate the memory held by fetched data (arrays nested in tuples,
+    lists and dicts).
+    """
+    
+    if isinstance(data, np.ndarray):
+        return data.nbytes
+    if isinstance(data, dict):
+        return sum(get_nbytes(x) for x in data.values())
+    if isinstance(data, (tuple, list)):
+        return sum(get_nbytes(x) for x in data)
+    return 0
+
+class Prefetcher(object):
+    """
+    Fetch data for upcoming channels on a background thread while the
+    current channel is being processed.
+
+    Iterating yields (channel, data, error) in channel order, where error
+    is the formatted traceback if fetching failed. At most `depth`
+    channels are held ahead of the consumer, and no new fetch is started
+    while the data already queued exceeds `max_bytes`. With depth 0,
+    channels are fetched synchronously as they are consumed.
+    """
+    
+    def __init__(self, fetch, channels, depth=2, max_bytes=None):
+        self.fetch = fetch
+        self.channels = list(channels)
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self._queue = deque()
+        self._queued_bytes = 0
+        self._done = False
+        self._stop = False
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def _fetch_one(self, channel):
+        try:
+            return self.fetch(channel), None
+        except Exception:
+            return None, traceback.format_exc()
+
+    def _full(self):
+        if len(self._queue) == 0:
+            return False
+        if len(self._queue) >= self.depth:
+            return True
+        return (self.max_bytes is not None and
+                self._queued_bytes >= self.max_bytes)
+
+    def _run(self):
+        for channel in self.channels:
+            with self._cond:
+                while self._full() and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    break
+            data, error = self._fetch_one(channel)
+            with self._cond:
+                nbytes = get_nbytes(data)
+                self._queue.append((channel, data, error, nbytes))
+                self._queued_bytes += nbytes
+                self._cond.notify_all()
+        with self._cond:
+            self._done = True
+            self._cond.notify_all()
+
+    def __iter__(self):
+        if self.depth <= 0:
+            for channel in self.channels:
+                data, error = self._fetch_one(channel)
+                yield channel, data, error
+            return
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+        try:
+            while True:
+                with self._cond:
+                    while len(self._queue) == 0 and not self._done:
+                        self._cond.wait()
+                    if len(self._queue) == 0:
+                        break
+                    channel, data, error, nbytes = self._queue.popleft()
+                    self._queued_bytes -= nbytes
+                    self._cond.notify_all()
+                yield channel, data, error
+                del data
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        Stop the background thread after its current fetch.
+        """
+        
+        with self._cond:
+            self._stop = True
+            self._queue.clear()
+            self._queued_bytes = 0
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -0,0 +1,61 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import cProfile
+import pstats
+import sys
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Number of functions listed in profile summaries
+PROFILE_TOP = 20
+
+#================================================================
+
+def parse_profile_channels(value):
+    """
+    Parse a comma-separated list of channels to profile. The special
+    value 'all' selects every channel.
+    """
+    
+    if value is None:
+        return []
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+def should_profile(channel, profile_channels):
+    """
+    Check if a channel was selected for profiling.
+    """
+    
+    return 'all' in profile_channels or channel in profile_channels
+
+def profile_call(func, args, filename, top=PROFILE_TOP, stream=sys.stdout):
+    """
+    Run a function under cProfile, dump the raw profile to file, and
+    print the top functions by cumulative and internal time.
+    """
+    
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        profiler.dump_stats(filename)
+        stats = pstats.Stats(filename, stream=stream)
+        stats.strip_dirs()
+        stream.write('\nProfile saved to %s\n' % filename)
+        stats.sort_stats('cumulative').print_stats(top)
+        stats.sort_stats('time').print_stats(top)
@@ -17,14 +17,16 @@
 
 from __future__ import division
 import numpy as np
-import matplotlib.mlab as mlab
 import os
-from glue import lal
-from pylal import frutils
 
 from . import utils as lcutils
 from . import (SEGMENT_FREQS, ALPHA)
 
+# Default number of Ok hours kept for median references
+REFERENCE_LENGTH = 24
+# Default percentile of those hours used as the reference
+REFERENCE_PERCENTILE = 50
+
 __author__ = 'Dipongkar Talukder <dipongkar.talukder@ligo.org>'
 
 #=======================================================================
@@ -54,10 +56,159 @@ def get_psd_ref_binned(psd, duration, segment_freqs=SEGMENT_FREQS):
     new_psd = np.concatenate(segments, axis=0)
     return new_psd
 
-def save_new_ref(psd, psd_new, filename, alpha=ALPHA):
+def save_ref(psd, filename, keep_previous=True, **fields):
+    """
+    Save a reference PSD atomically, keeping the replaced reference as
+    the previous generation. Single precision PSDs are written with the
+    digits needed to read them back exactly.
+    """
+    
+    if np.asarray(psd).dtype == np.float32:
+        fmt = '%.8e\n'
+    else:
+        fmt = '%.18e\n'
+    text = ''.join(fmt % x for x in psd)
+    lcutils.write_history(
+        filename, text, keep_previous=keep_previous, **fields)
+
+def load_ref(filename, before=None):
+    """
+    Load a reference PSD, falling back to the previous generation if the
+    file is missing or corrupt. Returns None if no valid reference exists,
+    in which case it has to be recomputed from frames. If the reference
+    was already updated with the hour at GPS time before (by an earlier
+    attempt of a retried job), the reference from before that update is
+    returned instead.
+    """
+    
+    history = lcutils.read_history(filename, parser=parse_ref)
+    if history is None:
+        return None
+    psd, fields = history
+    if before is not None and fields.get('gps') == str(before):
+        prev = lcutils.load_history(
+            lcutils.previous_generation(filename), parser=parse_ref)
+        if prev is None:
+            return None
+        return prev[0]
+    return psd
+
+def parse_ref(text):
+    """
+    Parse the text of a reference PSD file, raising ValueError if it
+    is not a valid PSD.
+    """
+    
+    psd = np.array([float(x) for x in text.split()])
+    if len(psd) == 0 or not np.all(np.isfinite(psd)):
+        raise ValueError("invalid reference PSD")
+    return psd
+
+def save_new_ref(psd, psd_new, filename, alpha=ALPHA, gps=None):
     """
     Combine the current psd to the reference and save it for future use.
+    The GPS time of the hour is recorded, so that a retried job redoing
+    the same hour replaces its own update instead of applying it twice.
     """
     
     psd_new = psd + alpha * (psd_new - psd)
-    np.savetxt(filename, psd_new)
\ No newline at end of file
+    if gps is None:
+        save_ref(psd_new, filename)
+        return
+    history = lcutils.load_history(filename)
+    redo = history is not None and history[1].get('gps') == str(gps)
+    # Keep the reference from before this hour as the previous generation
+    save_ref(psd_new, filename, keep_previous=not redo, gps=gps)
+
+class ReferenceRing(object):
+    """
+    Binned PSDs of a channel's most recent Ok hours, from which a
+    median (or other percentile) reference is taken.
+
+    The spectra are kept in a ring of a fixed number of rows, so the
+    memory and disk used per channel are constant. Unlike the
+    exponential average, a few unusual hours that pass the status checks
+    do not move the median reference. Spectra are kept as dtype.
+    """
+    
+    def __init__(self, length=REFERENCE_LENGTH, dtype=np.float64):
+        self.length = length
+        self.dtype = dtype
+        self.ring = None
+        self.times = np.zeros(length, dtype=np.int64)
+        self.count = 0
+        self.index = 0
+    
+    def add(self, psd, gps=0):
+        """
+        Add an hour's binned PSD, replacing the oldest once full, or
+        replacing the last one if it was added for the same GPS time by a
+        retried job. The ring is restarted if the number of bins changed.
+        """
+        
+        psd = np.asarray(psd, dtype=self.dtype)
+        if self.ring is None or self.ring.shape[1] != len(psd):
+            self.ring = np.zeros((self.length, len(psd)), dtype=self.dtype)
+            self.times = np.zeros(self.length, dtype=np.int64)
+            self.count = 0
+            self.index = 0
+        last = (self.index - 1) % self.length
+        if gps and self.count > 0 and self.times[last] == gps:
+            self.ring[last] = psd
+            return
+        self.ring[self.index] = psd
+        self.times[self.index] = gps
+        self.index = (self.index + 1) % self.length
+        self.count = min(self.count + 1, self.length)
+    
+    def get_ref(self, percentile=REFERENCE_PERCENTILE, exclude=None):
+        """
+        Percentile of the kept spectra in each bin, or None if empty.
+        Spectra added for GPS time exclude are left out.
+        """
+        
+        rows = np.arange(self.count)
+        if exclude:
+            rows = rows[self.times[:self.count] != exclude]
+        if len(rows) == 0:
+            return None
+        return np.percentile(self.ring[rows], percentile, axis=0)
+    
+    def save(self, filename):
+        """
+        Save the ring atomically.
+        """
+        
+        with lcutils.atomic_open(filename, 'wb') as f:
+            np.savez(f, ring=self.ring, times=self.times, count=self.count,
+                     index=self.index)
+
+def get_ring_file(ref_file):
+    """
+    File of a channel's reference ring, next to its EMA reference.
+    """
+    
+    return os.path.splitext(ref_file)[0] + '.ring.npz'
+
+def load_ring(filename, length=REFERENCE_LENGTH, dtype=np.float64):
+    """
+    Load a channel's reference ring, or start an empty one if there is
+    none, it is unreadable, or it was kept with a different length.
+    The kept spectra are converted to dtype.
+    """
+    
+    ring = ReferenceRing(length, dtype=dtype)
+    if not os.path.exists(filename):
+        return ring
+    try:
+        data = np.load(filename)
+        if data['ring'].shape[0] != length:
+            return ring
+        ring.ring = data['ring'].astype(dtype)
+        if 'times' in data.files:
+            ring.times = data['times']
+        ring.count = int(data['count'])
+        ring.index = int(data['index'])
+    except (IOError, ValueError, KeyError):
+        return ReferenceRing(length, dtype=dtype)
+    return ring
@@ -0,0 +1,184 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import re
+import shutil
+import tarfile
+
+from . import utils as lcutils
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Default retention (days) of intact job directories and image directories
+JOB_DAYS = 7
+IMAGE_DAYS = 30
+# What to do with job directories past retention: 'compact' or 'delete'
+JOB_ACTION = 'compact'
+# Image archives hold one GPS day of hourly image directories
+ARCHIVE_SPAN = 86400
+
+#================================================================
+
+def get_size(path):
+    """
+    Disk space in bytes used by a file or directory tree, counting whole
+    blocks, since the overhead of many small files is what is reclaimed.
+    """
+    
+    def disk_usage(filename):
+        stat = os.lstat(filename)
+        return getattr(stat, 'st_blocks', stat.st_size // 512) * 512
+
+    if not os.path.isdir(path):
+        return disk_usage(path)
+    size = 0
+    for root, dirs, fnames in os.walk(path):
+        size += disk_usage(root)
+        for fname in fnames:
+            try:
+                size += disk_usage(os.path.join(root, fname))
+            except OSError:
+                continue
+    return size
+
+def get_compacted_times(jobs_dir):
+    """
+    GPS times of job directories that have been compacted into tarballs.
+    """
+    
+    times = []
+    if not os.path.exists(jobs_dir):
+        return times
+    for fname in os.listdir(jobs_dir):
+        match = re.match(r'^(\d+)\.tar\.gz$', fname)
+        if match:
+            times.append(int(match.group(1)))
+    return sorted(times)
+
+def compact_dir(path):
+    """
+    Replace a directory by a gzipped tarball alongside it, named
+    <path>.tar.gz. Returns the number of bytes reclaimed.
+    """
+    
+    size = get_size(path)
+    tar_file = path.rstrip('/') + '.tar.gz'
+    with lcutils.atomic_open(tar_file, 'wb') as f:
+        with tarfile.open(fileobj=f, mode='w:gz') as tar:
+            tar.add(path, arcname=os.path.basename(path.rstrip('/')))
+    shutil.rmtree(path)
+    return size - get_size(tar_file)
+
+def remove(path):
+    """
+    Delete a file or directory tree. Returns the number of bytes reclaimed.
+    """
+    
+    size = get_size(path)
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+    return size
+
+def get_archive_name(month_dir, gps):
+    """
+    Name (without extension) of a new archive for the day containing gps.
+    Days packed again later, e.g. after a replay, get numbered parts.
+    """
+    
+    day = gps - gps % ARCHIVE_SPAN
+    name = os.path.join(month_dir, str(day))
+    part = 0
+    while os.path.exists(name + '.tar'):
+        part += 1
+        name = os.path.join(month_dir, '%d-%d' % (day, part))
+    return name
+
+def pack_dirs(dirs, archive_name):
+    """
+    Pack hourly image directories into an uncompressed tar archive,
+    <archive_name>.tar, and write an index of the offset and size of every
+    member to <archive_name>.idx, so single images can be read back without
+    unpacking. The directories are removed once both are written. Returns
+    the number of bytes reclaimed.
+    """
+    
+    size = sum(get_size(d) for d in dirs)
+    tar_file = archive_name + '.tar'
+    with lcutils.atomic_open(tar_file, 'wb') as f:
+        with tarfile.open(fileobj=f, mode='w') as tar:
+            for d in dirs:
+                tar.add(d, arcname=os.path.basename(d.rstrip('/')))
+    lines = []
+    with tarfile.open(tar_file, 'r') as tar:
+        for member in tar.getmembers():
+            if member.isfile():
+                lines.append('%s %d %d\n' % (
+                    member.name, member.offset_data, member.size))
+    with lcutils.atomic_open(archive_name + '.idx') as f:
+        f.writelines(lines)
+    for d in dirs:
+        shutil.rmtree(d)
+    return size - get_size(tar_file) - get_size(archive_name + '.idx')
+
+def read_packed_image(images_dir, image_dir, filename):
+    """
+    Read an image from the daily archives of images_dir (e.g.
+    out_dir/images/ASD), given its <YYYY_MM>/<gps> image directory and
+    file name. Returns the image bytes, or None if it was never packed.
+    """
+    
+    month, gps = image_dir.split('/')
+    month_dir = os.path.join(images_dir, month)
+    if not os.path.isdir(month_dir):
+        return None
+    day = int(gps) - int(gps) % ARCHIVE_SPAN
+    member = '%s/%s' % (gps, filename)
+    pattern = re.compile(r'^%d(-\d+)?\.idx$' % day)
+    for fname in sorted(os.listdir(month_dir)):
+        if not pattern.match(fname):
+            continue
+        index_file = os.path.join(month_dir, fname)
+        with open(index_file, 'r') as f:
+            for line in f:
+                name, offset, size = line.rsplit(' ', 2)
+                if name != member:
+                    continue
+                with open(index_file[:-4] + '.tar', 'rb') as tar:
+                    tar.seek(int(offset))
+                    return tar.read(int(size))
+    return None
+
+def get_referenced_dirs(results_files, image_idx=18):
+    """
+    Image directories (<YYYY_MM>/<gps>) referenced by results files.
+    Channels whose data did not change reuse an earlier hour's plots, so
+    these must stay in place even past retention.
+    """
+    
+    referenced = set()
+    for filename in results_files:
+        if not os.path.exists(filename):
+            continue
+        with open(filename, 'r') as f:
+            for line in f:
+                split = line.rstrip().split(',')
+                if len(split) > image_idx and split[image_idx]:
+                    referenced.add(split[image_idx])
+    return referenced
@@ -0,0 +1,231 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import shutil
+import time
+import numpy as np
+from getpass import getuser
+
+from . import utils as lcutils
+from .staging import file_lock
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Node-local shared memory filesystem holding decoded frame data
+SHM_DIR = '/dev/shm'
+# Default limit (bytes) on decoded data held in shared memory per user
+SHM_MAX_BYTES = 4 * 2**30
+# Seconds a worker waits for the loader before reading frames itself
+SHM_WAIT = 300
+# Seconds between checks while waiting
+SHM_POLL = 0.5
+
+#================================================================
+
+def get_shared_dir(gps, root=SHM_DIR):
+    """
+    Shared memory directory for one data window of the current user.
+    """
+    
+    return os.path.join(root, 'ligocam-%s' % getuser(), str(gps))
+
+def get_load_order(channel_lists, workers):
+    """
+    Order in which a loader should decode channels for jobs that each
+    process a channel list in order, at most workers jobs at a time:
+    round-robin over the lists of each group of jobs running together.
+    """
+    
+    order = []
+    for i in range(0, len(channel_lists), workers):
+        group = channel_lists[i:i + workers]
+        for j in range(max(len(x) for x in group)):
+            order += [x[j] for x in group if j < len(x)]
+    return order
+
+class SharedBuffers(object):
+    """
+    Decoded time series of one data window, shared between processes on
+    a node through files in shared memory (/dev/shm).
+
+    A loader process decodes each channel once and publishes it as a
+    .npy file; workers attach to it as a read-only memory map, so every
+    process sees the same pages instead of holding its own copy. Each
+    buffer counts its consumers and is removed when the last one
+    releases it. The loader waits while the buffers of all windows
+    exceed max_bytes, so memory use does not grow with the number of
+    workers. Channels the loader could not decode are marked as skipped,
+    and if a worker waits too long for the loader, the window is marked
+    as done; either way workers then read the data from frames.
+    """
+    
+    def __init__(self, path, max_bytes=SHM_MAX_BYTES, wait=SHM_WAIT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.wait = wait
+
+    def get_file(self, channel, ext):
+        """
+        File of a channel's buffer or marker in the window's directory.
+        """
+        
+        return os.path.join(self.path, channel.replace(':', '_') + ext)
+
+    def lock(self):
+        """
+        Lock held while buffers or markers change.
+        """
+        
+        return file_lock(os.path.join(self.path, 'lock'))
+
+    def start(self, channels):
+        """
+        Record the channels the loader is going to publish.
+        """
+        
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        with lcutils.atomic_open(os.path.join(self.path, 'manifest')) as f:
+            f.write(''.join(c + '\n' for c in channels))
+
+    def finish(self):
+        """
+        Mark the loader as done; workers stop waiting for what is left.
+        """
+        
+        with open(os.path.join(self.path, 'done'), 'w'):
+            pass
+
+    def is_done(self):
+        """
+        Check if the loader finished, or a worker gave up waiting for it.
+        """
+        
+        return os.path.exists(os.path.join(self.path, 'done'))
+
+    def get_used_bytes(self):
+        """
+        Bytes held by the buffers of every window of this user.
+        """
+        
+        used = 0
+        for root, dirs, fnames in os.walk(os.path.dirname(self.path)):
+            for fname in fnames:
+                if fname.endswith('.npy'):
+                    try:
+                        used += os.path.getsize(os.path.join(root, fname))
+                    except OSError:
+                        continue
+        return used
+
+    def publish(self, channel, x, consumers=1):
+        """
+        Publish a channel's decoded time series for a number of
+        consumers, once there is room for it. If no room frees up within
+        the wait, or the workers stopped waiting, the channel is skipped
+        and False is returned.
+        """
+        
+        x = np.asarray(x)
+        t_start = time.time()
+        while True:
+            used = self.get_used_bytes()
+            if used == 0 or used + x.nbytes <= self.max_bytes:
+                break
+            if self.is_done() or time.time() - t_start > self.wait:
+                # Consumers of this channel read it from frames instead
+                with self.lock():
+                    self.skip(channel)
+                return False
+            time.sleep(SHM_POLL)
+        with self.lock():
+            if self.is_done() or \
+               os.path.exists(self.get_file(channel, '.skip')):
+                return False
+            with open(self.get_file(channel, '.refs'), 'w') as f:
+                f.write('%d\n' % consumers)
+            with lcutils.atomic_open(self.get_file(channel, '.npy'),
+                                     'wb') as f:
+                np.save(f, x)
+        return True
+
+    def skip(self, channel):
+        """
+        Mark a channel as not coming from shared memory.
+        """
+        
+        with open(self.get_file(channel, '.skip'), 'w'):
+            pass
+
+    def attach(self, channel):
+        """
+        Attach to a channel's buffer as a read-only array, waiting for the
+        loader if it has not published it yet. Returns None if the channel
+        is not being loaded, so the caller reads it from frames.
+        """
+        
+        manifest = os.path.join(self.path, 'manifest')
+        if not os.path.exists(manifest):
+            return None
+        with open(manifest, 'r') as f:
+            if channel + '\n' not in f.readlines():
+                return None
+        npy_file = self.get_file(channel, '.npy')
+        t_start = time.time()
+        while True:
+            with self.lock():
+                if os.path.exists(npy_file):
+                    return np.load(npy_file, mmap_mode='r')
+                if os.path.exists(self.get_file(channel, '.skip')):
+                    return None
+                if self.is_done():
+                    return None
+                if time.time() - t_start > self.wait:
+                    # The loader is stuck; every job reads its own data
+                    self.finish()
+                    return None
+            time.sleep(SHM_POLL)
+
+    def release(self, channel):
+        """
+        Drop one consumer of a channel's buffer, removing it after the
+        last one. Arrays already attached stay valid until deleted.
+        """
+        
+        refs_file = self.get_file(channel, '.refs')
+        with self.lock():
+            if not os.path.exists(refs_file):
+                return
+            with open(refs_file, 'r') as f:
+                consumers = int(f.read()) - 1
+            if consumers > 0:
+                with open(refs_file, 'w') as f:
+                    f.write('%d\n' % consumers)
+                return
+            for ext in ['.npy', '.refs']:
+                filename = self.get_file(channel, ext)
+                if os.path.exists(filename):
+                    os.remove(filename)
+
+    def cleanup(self):
+        """
+        Remove the window's directory and any buffers left in it.
+        """
+        
+        if os.path.isdir(self.path):
+            shutil.rmtree(self.path)
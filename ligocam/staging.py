@@ -0,0 +1,190 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import fcntl
+import hashlib
+import os
+import shutil
+import sys
+import time
+from contextlib import contextmanager
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Default size limit of the staging area (bytes)
+STAGING_MAX_BYTES = 50 * 2**30
+# Staged files used more recently than this (seconds) are never evicted,
+# since a running job may still read them
+STAGING_MIN_AGE = 3600
+
+#================================================================
+
+@contextmanager
+def file_lock(filename, shared=False):
+    """
+    Hold an flock on a lock file for the duration of the block. Lock
+    files may be removed by their holder, so after locking, the file
+    is checked to still be the one at filename, and opened again if not.
+    """
+    
+    while True:
+        f = open(filename, 'a')
+        if shared:
+            fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            current = os.path.samestat(
+                os.fstat(f.fileno()), os.stat(filename))
+        except OSError:
+            current = False
+        if current:
+            break
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+    try:
+        yield f
+    finally:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+        f.close()
+
+class FrameStager(object):
+    """
+    Node-local staging area for frame files shared by all jobs on a node.
+
+    Each frame file is copied once into scratch_dir under a key made from
+    its path, mtime and size, so a replaced file is staged again. Later
+    reads of the same file, by this or any other job on the node, go to
+    the local copy. Copies are made under a per-file lock so concurrent
+    jobs never copy the same file twice, and the oldest copies are evicted
+    under a directory lock once the total size exceeds max_bytes.
+    """
+    
+    def __init__(self, scratch_dir, max_bytes=STAGING_MAX_BYTES,
+                 min_age=STAGING_MIN_AGE):
+        self.scratch_dir = scratch_dir
+        self.max_bytes = max_bytes
+        self.min_age = min_age
+        if not os.path.exists(scratch_dir):
+            try:
+                os.makedirs(scratch_dir)
+            except OSError:
+                if not os.path.isdir(scratch_dir):
+                    raise
+
+    def get_key(self, path, stat):
+        """
+        Staging key for a frame file.
+        """
+        
+        path_hash = hashlib.sha1(path.encode('utf-8')).hexdigest()[:16]
+        return '%s-%d-%d-%s' % (
+            path_hash, int(stat.st_mtime), stat.st_size,
+            os.path.basename(path))
+
+    def stage(self, path):
+        """
+        Return the path of a local copy of a frame file, copying it into
+        the staging area if it is not there yet.
+        """
+        
+        stat = os.stat(path)
+        local = os.path.join(self.scratch_dir, self.get_key(path, stat))
+        copied = False
+        with file_lock(local + '.lock'):
+            if not os.path.exists(local):
+                partial = '%s.part.%d' % (local, os.getpid())
+                shutil.copyfile(path, partial)
+                os.rename(partial, local)
+                copied = True
+            # Record the use for LRU eviction, under the lock so the copy
+            # cannot be evicted in between
+            os.utime(local, None)
+        if copied:
+            self.evict(keep=local)
+        return local
+
+    def staged_files(self):
+        """
+        List staged files as (mtime, size, path), oldest first.
+        """
+        
+        files = []
+        for fname in os.listdir(self.scratch_dir):
+            if fname.endswith('.lock') or '.part.' in fname:
+                continue
+            fullname = os.path.join(self.scratch_dir, fname)
+            try:
+                stat = os.stat(fullname)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, fullname))
+        return sorted(files)
+
+    def evict(self, keep=None):
+        """
+        Remove least recently used files until the staging area fits in
+        max_bytes. Returns the number of bytes freed.
+        """
+        
+        freed = 0
+        with file_lock(os.path.join(self.scratch_dir, '.lock')):
+            files = self.staged_files()
+            total = sum(size for _, size, _ in files)
+            now = time.time()
+            for mtime, size, fullname in files:
+                if total <= self.max_bytes:
+                    break
+                if fullname == keep or now - mtime < self.min_age:
+                    continue
+                with file_lock(fullname + '.lock'):
+                    try:
+                        # Skip it if it was used again since it was listed
+                        if os.path.getmtime(fullname) != mtime:
+                            continue
+                        os.remove(fullname)
+                    except OSError:
+                        continue
+                    # Removed while held; file_lock notices a removed
+                    # lock file and locks the new one instead
+                    os.remove(fullname + '.lock')
+                total -= size
+                freed += size
+        return freed
+
+    def stage_cache_line(self, line):
+        """
+        Rewrite a LAL cache line to point at the staged copy of its frame
+        file. The original line is kept if staging fails.
+        """
+        
+        fields = line.split()
+        if len(fields) < 5:
+            return line
+        url = fields[-1]
+        path = url[len('file://localhost'):] if \
+            url.startswith('file://localhost') else url
+        if path.startswith('file://'):
+            path = path[len('file://'):]
+        try:
+            local = self.stage(path)
+        except (IOError, OSError) as e:
+            sys.stderr.write(
+                "warning: could not stage %s (%s)\n" % (path, e))
+            return line
+        fields[-1] = 'file://localhost' + local
+        return ' '.join(fields)
@@ -0,0 +1,178 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import numpy as np
+
+from . import utils as lcutils
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Default size limit (bytes) of the cache of images rendered on demand
+RENDER_CACHE_MAX_BYTES = 2 * 2**30
+
+# Arrays kept for each channel, split into segments where applicable
+SEGMENTED_FIELDS = ['freq_binned', 'psd_binned', 'psd_ref_binned']
+# Unbinned spectrum reduced for plotting, one segment per ASD panel
+REDUCED_FIELDS = ['freq_reduced', 'psd_reduced']
+TIMESERIES_FIELDS = [
+    'envelope_time', 'envelope_min', 'envelope_max', 'start', 'end']
+
+#================================================================
+
+def get_channel_data(ts_reduced, current_utc, binned_segs=None,
+                     flatline=None, reduced_segs=None):
+    """
+    Collect what is needed to redraw a channel's plots into a dict of
+    float32 arrays: the reduced time series and, unless the data were
+    flatlined, the (freq, psd, reference psd) binned segment lists and
+    the (freq, psd) panels of the reduced unbinned spectrum.
+    Segment lists are concatenated, with their lengths kept alongside.
+    """
+    
+    data = {'utc': np.array(current_utc)}
+    segmented = []
+    if binned_segs is not None:
+        segmented += zip(SEGMENTED_FIELDS, binned_segs)
+    if reduced_segs is not None:
+        segmented += zip(REDUCED_FIELDS, reduced_segs)
+    for name, segs in segmented:
+        data[name] = np.concatenate(segs).astype(np.float32)
+        data[name + '_lengths'] = np.array([len(x) for x in segs])
+    if flatline:
+        data['flatline'] = np.array(flatline)
+    for name in TIMESERIES_FIELDS:
+        data[name] = np.asarray(ts_reduced[name], dtype=np.float32)
+    data['sample_rate'] = np.array(ts_reduced['sample_rate'])
+    data['duration'] = np.array(ts_reduced['duration'])
+    return data
+
+def save_channel_data(filename, data):
+    """
+    Save a single channel's plot data from a job.
+    """
+    
+    with lcutils.atomic_open(filename, 'wb') as f:
+        np.savez(f, **data)
+
+def merge_channel_data(files, store_file):
+    """
+    Combine the plot data of every channel in an hour into one store
+    file. Arrays are keyed by '<channel_filename>.<field>'.
+    """
+    
+    merged = {}
+    for filename in files:
+        channel_filename = os.path.basename(filename)[len('data_'):-4]
+        with np.load(filename) as data:
+            for key in data.files:
+                merged['%s.%s' % (channel_filename, key)] = data[key]
+    with lcutils.atomic_open(store_file, 'wb') as f:
+        np.savez_compressed(f, **merged)
+
+def load_channel_data(store_file, channel):
+    """
+    Load a channel's plot data from an hourly store file, or None if the
+    channel is not in it.
+    """
+    
+    prefix = channel.replace(':', '_') + '.'
+    with np.load(store_file) as store:
+        keys = [x for x in store.files if x.startswith(prefix)]
+        if len(keys) == 0:
+            return None
+        data = dict((x[len(prefix):], store[x]) for x in keys)
+    for name in SEGMENTED_FIELDS + REDUCED_FIELDS:
+        if name not in data:
+            continue
+        edges = np.cumsum(data.pop(name + '_lengths'))[:-1]
+        data[name] = np.split(data[name], edges)
+    data['utc'] = str(data['utc'])
+    if 'flatline' in data:
+        data['flatline'] = str(data['flatline'])
+    return data
+
+def render(data, channel, kind, filename):
+    """
+    Draw a channel's ASD or TS plot from its stored data. The binned
+    spectra stand in for the unbinned ones in stores written before the
+    reduced unbinned spectrum was kept.
+    """
+    
+    from . import plot as lcplot
+    
+    if 'flatline' in data:
+        lcplot.placeholder_plot(
+            channel, filename, 'Dead data: %s' % data['flatline'],
+            data['utc'])
+    elif kind == 'ASD':
+        freq_binned_segs = data['freq_binned']
+        asd_binned_segs = [np.sqrt(x) for x in data['psd_binned']]
+        asd_ref_binned_segs = [np.sqrt(x) for x in data['psd_ref_binned']]
+        if 'freq_reduced' in data:
+            lcplot.asd_plot(
+                channel, filename, data['freq_reduced'], freq_binned_segs,
+                [np.sqrt(x) for x in data['psd_reduced']], asd_binned_segs,
+                asd_ref_binned_segs, data['utc'], reduced=True)
+        else:
+            lcplot.asd_plot(
+                channel, filename, freq_binned_segs, freq_binned_segs,
+                asd_binned_segs, asd_binned_segs, asd_ref_binned_segs,
+                data['utc'])
+    else:
+        ts_reduced = dict((x, data[x]) for x in TIMESERIES_FIELDS)
+        ts_reduced['sample_rate'] = int(data['sample_rate'])
+        ts_reduced['duration'] = int(data['duration'])
+        lcplot.timeseries_plot(channel, filename, ts_reduced, data['utc'])
+
+def get_store_file(store_dir, image_dir):
+    """
+    Store file of an hour, given its <YYYY_MM>/<gps> image directory.
+    """
+    
+    return os.path.join(store_dir, image_dir + '.npz')
+
+def evict_cache(cache_dir, max_bytes=RENDER_CACHE_MAX_BYTES, keep=None):
+    """
+    Remove least recently used images until the render cache fits in
+    max_bytes. Returns the number of bytes freed.
+    """
+    
+    files = []
+    for root, dirs, fnames in os.walk(cache_dir):
+        for fname in fnames:
+            fullname = os.path.join(root, fname)
+            try:
+                stat = os.stat(fullname)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, fullname))
+    files.sort()
+    total = sum(size for _, size, _ in files)
+    freed = 0
+    for mtime, size, fullname in files:
+        if total <= max_bytes:
+            break
+        if fullname == keep:
+            continue
+        try:
+            os.remove(fullname)
+        except OSError:
+            continue
+        total -= size
+        freed += size
+    return freed
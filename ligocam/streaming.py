@@ -0,0 +1,260 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+from __future__ import division
+import numpy as np
+
+from . import utils as lcutils
+from . import ENVELOPE_POINTS
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Sample rate of the decimated stream used for full-resolution low
+# frequencies; below LOW_SPLIT * (LOW_RATE / 2) the PSD is computed over
+# the full duration, above it Welch averages are interpolated
+LOW_RATE = 1024
+LOW_SPLIT = 0.6
+# Highest frequency (Hz) used by the status checks in
+# analysis.channel_status. Their band minima must come from the
+# full-duration periodogram, not from Welch averages.
+STATUS_FMAX = 300
+# Defaults for Welch segments and frame reads, in seconds
+STREAM_FFTLENGTH = 8
+STREAM_CHUNK = 64
+# Channels slower than this are not worth streaming
+STREAM_MIN_RATE = 4096
+
+#================================================================
+
+def onesided_psd(x, sample_rate, window):
+    """
+    One-sided PSD of a single windowed segment, scaled the same way as
+    mlab.psd with scale_by_freq.
+    """
+    
+    spec = np.abs(np.fft.rfft(x * window)) ** 2
+    spec /= sample_rate * (window ** 2).sum()
+    if len(x) % 2 == 0:
+        spec[1:-1] *= 2
+    else:
+        spec[1:] *= 2
+    return spec
+
+class StreamingPSD(object):
+    """
+    Accumulate the PSD of a time series one chunk at a time without
+    holding the full series.
+
+    Frequencies above the split are Welch averages of Hann-windowed
+    segments with the given length and overlap. Frequencies below the
+    split come from a periodogram of a low-pass filtered, decimated copy
+    of the stream spanning the full duration, so the 1/duration
+    resolution of the low-frequency segments (and of narrow lines such as
+    the 60 Hz checks in analysis.channel_status) is preserved. The split
+    is kept above STATUS_FMAX, so every status check sees the same
+    single-periodogram statistics as without streaming; the Welch part
+    only affects the BLRMS bands and plots above it. The output
+    is returned on the same 1/duration frequency grid as utils.get_data.
+    """
+    
+    def __init__(self, sample_rate, duration, fftlength=STREAM_FFTLENGTH,
+                 overlap=None, low_rate=LOW_RATE, low_split=LOW_SPLIT,
+                 envelope_points=ENVELOPE_POINTS):
+        from scipy import signal
+        if overlap is None:
+            overlap = fftlength / 2
+        self.sample_rate = int(sample_rate)
+        self.duration = duration
+        self.num_samples = 0
+        # Welch segments
+        self.nfft = int(fftlength * sample_rate)
+        self.nstep = self.nfft - int(overlap * sample_rate)
+        if self.nstep <= 0:
+            raise ValueError("overlap must be shorter than fftlength")
+        self.window = np.hanning(self.nfft)
+        self.welch_sum = np.zeros(self.nfft // 2 + 1)
+        self.num_segments = 0
+        self.carry = np.zeros(0)
+        # Decimated stream for low frequencies
+        self.low_rate = min(low_rate, self.sample_rate)
+        self.low_split = low_split * self.low_rate / 2
+        self.decimation = self.sample_rate // self.low_rate
+        if self.decimation > 1 and self.low_split < STATUS_FMAX:
+            raise ValueError(
+                "low-frequency split must be above %d Hz" % STATUS_FMAX)
+        if self.decimation > 1:
+            self.sos = signal.cheby1(
+                8, 0.01, 0.8 / self.decimation, output='sos')
+        self.zi = None
+        self.low = np.zeros(int(self.low_rate * duration))
+        self.num_low = 0
+        # Time series kept for plotting
+        self.bin_size = max(
+            1, int(np.ceil(self.sample_rate * duration / envelope_points)))
+        self.env_min = []
+        self.env_max = []
+        self.env_carry = np.zeros(0)
+        self.start = np.zeros(0, dtype=np.float32)
+        self.end = np.zeros(0, dtype=np.float32)
+
+    def update(self, x):
+        """
+        Add the next chunk of data to the running spectrum.
+        """
+        
+        x = np.asarray(x, dtype=np.float64)
+        self._update_welch(x)
+        self._update_low(x)
+        self._update_timeseries(x)
+        self.num_samples += len(x)
+
+    def _update_welch(self, x):
+        buf = np.concatenate((self.carry, x))
+        start = 0
+        while start + self.nfft <= len(buf):
+            self.welch_sum += np.abs(
+                np.fft.rfft(buf[start:start + self.nfft] * self.window)) ** 2
+            self.num_segments += 1
+            start += self.nstep
+        self.carry = buf[start:]
+
+    def _update_low(self, x):
+        from scipy import signal
+        if self.decimation > 1:
+            if self.zi is None:
+                self.zi = signal.sosfilt_zi(self.sos) * x[0]
+            y, self.zi = signal.sosfilt(self.sos, x, zi=self.zi)
+            phase = (-self.num_samples) % self.decimation
+            y = y[phase::self.decimation]
+        else:
+            y = x
+        n = min(len(y), len(self.low) - self.num_low)
+        self.low[self.num_low:self.num_low + n] = y[:n]
+        self.num_low += n
+
+    def _update_timeseries(self, x):
+        fs = self.sample_rate
+        if len(self.start) < fs + 1:
+            self.start = np.concatenate(
+                (self.start, x[:fs + 1 - len(self.start)].astype(np.float32)))
+        self.end = np.concatenate(
+            (self.end, x[-(fs + 1):].astype(np.float32)))[-(fs + 1):]
+        buf = np.concatenate((self.env_carry, x))
+        n_full = (len(buf) // self.bin_size) * self.bin_size
+        if n_full > 0:
+            x_min, x_max = lcutils.get_envelope(buf[:n_full], self.bin_size)
+            self.env_min.append(x_min.astype(np.float32))
+            self.env_max.append(x_max.astype(np.float32))
+        self.env_carry = buf[n_full:]
+
+    def get_psd(self):
+        """
+        Combine the accumulated spectra into a PSD on the full-duration
+        frequency grid.
+        """
+        
+        if self.num_segments == 0:
+            raise ValueError("not enough data for a single Welch segment")
+        fs = self.sample_rate
+        n = self.num_samples
+        freq = np.arange(n // 2 + 1) * fs / n
+        # Welch average for high frequencies
+        welch_freq = np.arange(self.nfft // 2 + 1) * fs / self.nfft
+        welch_psd = self.welch_sum / self.num_segments
+        welch_psd /= fs * (self.window ** 2).sum()
+        if self.nfft % 2 == 0:
+            welch_psd[1:-1] *= 2
+        else:
+            welch_psd[1:] *= 2
+        psd = np.interp(freq, welch_freq, welch_psd)
+        # Full-duration periodogram of decimated data for low frequencies
+        low = self.low[:self.num_low]
+        low_psd = onesided_psd(low, self.low_rate, np.hanning(len(low)))
+        if self.decimation > 1:
+            k_split = min(int(self.low_split * n / fs), len(low_psd))
+        else:
+            k_split = len(low_psd)
+        psd[:k_split] = low_psd[:k_split]
+        return psd, freq
+
+    def get_timeseries(self):
+        """
+        Reduced time series in the format of utils.reduce_timeseries.
+        """
+        
+        env_min = list(self.env_min)
+        env_max = list(self.env_max)
+        if len(self.env_carry) > 0:
+            env_min.append(np.array([self.env_carry.min()], np.float32))
+            env_max.append(np.array([self.env_carry.max()], np.float32))
+        env_min = np.concatenate(env_min)
+        env_max = np.concatenate(env_max)
+        env_time = np.arange(len(env_min)) * self.bin_size / self.sample_rate
+        ts_reduced = {
+            'sample_rate': self.sample_rate,
+            'duration': self.duration,
+            'envelope_time': env_time.astype(np.float32),
+            'envelope_min': env_min,
+            'envelope_max': env_max,
+            'start': self.start,
+            'end': self.end
+        }
+        return ts_reduced
+
+def get_data_streaming(frame_cache, channel, time, duration, overlap=None,
+                       fftlength=STREAM_FFTLENGTH, chunk=STREAM_CHUNK,
+                       min_rate=STREAM_MIN_RATE, precheck=None):
+    """
+    Fetch a channel from frame cache in chunks, accumulating its PSD and
+    reduced time series as it goes. Channels sampled below min_rate are
+    read whole and analyzed with utils.get_data's full periodogram.
+    
+    If a precheck function is given and flags the first chunk as dead
+    data, the channel is read whole and checked again; if it is still
+    flagged, no PSD is computed, None is returned for psd and freq, and
+    the precheck result is stored in the reduced time series as
+    'flatline'.
+    """
+    
+    t0 = time
+    t1 = min(time + chunk, time + duration)
+    x = frame_cache.fetch(channel, t0, t1)
+    sample_rate = int(round(len(x) / (t1 - t0)))
+    suspect = precheck is not None and precheck(np.asarray(x))
+    if sample_rate < min_rate or suspect:
+        chunks = [np.asarray(x)]
+        if t1 < time + duration:
+            chunks.append(
+                np.asarray(frame_cache.fetch(channel, t1, time + duration)))
+        ts = np.concatenate(chunks)
+        del chunks, x
+        ts_reduced = lcutils.reduce_timeseries(ts, duration)
+        if precheck is not None:
+            ts_reduced['flatline'] = precheck(ts)
+            if ts_reduced['flatline']:
+                return ts_reduced, None, None
+        psd, freq = lcutils.compute_psd(ts, duration, overlap=overlap or 0)
+        return ts_reduced, psd, freq
+    stream = StreamingPSD(
+        sample_rate, duration, fftlength=fftlength, overlap=overlap)
+    stream.update(x)
+    while t1 < time + duration:
+        t0 = t1
+        t1 = min(t0 + chunk, time + duration)
+        stream.update(frame_cache.fetch(channel, t0, t1))
+    psd, freq = stream.get_psd()
+    return stream.get_timeseries(), psd, freq
@@ -0,0 +1,251 @@
+# Copyright (C) 2013 Dipongkar Talukder
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program. If not, see <http://www.gnu.org/licenses/>.
+
+""" This file is part of LIGO Channel Activity Monitor (LigoCAM)."""
+
+import os
+import re
+import warnings
+import numpy as np
+
+from . import utils as lcutils
+from .staging import file_lock
+from . import SEGMENT_EDGES
+
+__author__ = 'Philippe Nguyen <philippe.nguyen@ligo.org>'
+
+# Number of binned PSD points kept per channel (shorter spectra of
+# low-rate channels are padded with NaN)
+TREND_BINS = SEGMENT_EDGES[-1]
+# Levels of the trend pyramid: (name, seconds per row, seconds per file).
+# Each level's rows are averages of the rows of the level before it.
+TREND_LEVELS = [
+    ('hour', 3600, 28 * 86400),
+    ('day', 86400, 364 * 86400),
+    ('week', 7 * 86400, None)
+]
+
+#================================================================
+
+def read_catalog(trend_dir):
+    """
+    Channels of a trend archive, in the order of their columns, and
+    their binned frequencies as an array of shape (channels, TREND_BINS).
+    """
+    
+    catalog_file = os.path.join(trend_dir, 'channels.txt')
+    freqs_file = os.path.join(trend_dir, 'freqs.npy')
+    if not os.path.exists(catalog_file):
+        return [], np.zeros((0, TREND_BINS), dtype=np.float32)
+    with open(catalog_file, 'r') as f:
+        channels = [line.rstrip() for line in f if line.strip()]
+    freqs = np.load(freqs_file)
+    return channels, freqs
+
+def update_catalog(trend_dir, spectra):
+    """
+    Add channels not yet in the archive to the end of its catalog, so
+    existing columns never move. spectra is a dict of
+    channel: (freq_binned, psd_binned). Returns the updated catalog.
+    """
+    
+    channels, freqs = read_catalog(trend_dir)
+    new = sorted(c for c in spectra.keys() if c not in channels)
+    if len(new) == 0:
+        return channels, freqs
+    new_freqs = np.full((len(new), TREND_BINS), np.nan, dtype=np.float32)
+    for i, channel in enumerate(new):
+        freq = spectra[channel][0][:TREND_BINS]
+        new_freqs[i, :len(freq)] = freq
+    channels = channels + new
+    freqs = np.concatenate([freqs, new_freqs], axis=0)
+    with lcutils.atomic_open(os.path.join(trend_dir, 'freqs.npy'), 'wb') as f:
+        np.save(f, freqs)
+    with lcutils.atomic_open(os.path.join(trend_dir, 'channels.txt')) as f:
+        f.write(''.join(c + '\n' for c in channels))
+    return channels, freqs
+
+def get_segments(level_dir):
+    """
+    Files of one trend level as a sorted list of (start time, number of
+    channels, path without extension). Each file holds float32 rows of
+    shape (channels, TREND_BINS), with their times in a .times file.
+    """
+    
+    segments = []
+    if not os.path.isdir(level_dir):
+        return segments
+    for fname in os.listdir(level_dir):
+        match = re.match(r'^(\d+)_(\d+)\.dat$', fname)
+        if match:
+            segments.append((
+                int(match.group(1)), int(match.group(2)),
+                os.path.join(level_dir, fname[:-4])))
+    return sorted(segments)
+
+def read_segment(path, num_channels):
+    """
+    Row times and a read-only memmap of the rows of one trend file.
+    Rows written without their time (after a crash) are ignored.
+    """
+    
+    times = np.fromfile(path + '.times', dtype=np.int64)
+    row_size = num_channels * TREND_BINS * 4
+    num_rows = min(len(times), os.path.getsize(path + '.dat') // row_size)
+    if num_rows == 0:
+        return times[:0], np.zeros((0, num_channels, TREND_BINS),
+                                   dtype=np.float32)
+    rows = np.memmap(path + '.dat', dtype=np.float32, mode='r',
+                     shape=(num_rows, num_channels, TREND_BINS))
+    return times[:num_rows], rows
+
+def write_row(level_dir, file_span, gps, row):
+    """
+    Write a row of shape (channels, TREND_BINS) for time gps to a trend
+    level, replacing the row already written for that time, if any.
+    """
+    
+    num_channels = row.shape[0]
+    if file_span is None:
+        start = 0
+    else:
+        start = gps - gps % file_span
+    path = os.path.join(level_dir, '%d_%d' % (start, num_channels))
+    row = np.ascontiguousarray(row, dtype=np.float32)
+    if os.path.exists(path + '.dat'):
+        times, rows = read_segment(path, num_channels)
+        idx = np.where(times == gps)[0]
+        del rows
+    else:
+        if not os.path.isdir(level_dir):
+            os.makedirs(level_dir)
+        times = np.zeros(0, dtype=np.int64)
+        idx = []
+    if len(idx) > 0:
+        with open(path + '.dat', 'r+b') as f:
+            f.seek(idx[0] * row.nbytes)
+            f.write(row.tobytes())
+        return
+    # Truncate any partial row left by a crash before appending
+    with open(path + '.dat', 'ab') as f:
+        f.truncate(len(times) * row.nbytes)
+        f.write(row.tobytes())
+    with open(path + '.times', 'ab') as f:
+        f.truncate(len(times) * 8)
+        f.write(np.array([gps], dtype=np.int64).tobytes())
+
+def load_trend(trend_dir, level='hour', start=0, end=None, channels=None):
+    """
+    Load rows of a trend level between start and end (GPS). Returns the
+    row times, the selected channels, and an array of shape (times,
+    channels, TREND_BINS) with NaN where a channel has no data. Only the
+    requested rows and channels are read from disk.
+    """
+    
+    catalog = read_catalog(trend_dir)[0]
+    if channels is None:
+        channels = catalog
+    columns = [catalog.index(c) if c in catalog else None for c in channels]
+    level_dir = os.path.join(trend_dir, level)
+    all_times = []
+    all_rows = []
+    for seg_start, num_channels, path in get_segments(level_dir):
+        times, rows = read_segment(path, num_channels)
+        keep = np.where((times >= start) &
+                        ((times < end) if end is not None else True))[0]
+        if len(keep) == 0:
+            continue
+        data = np.full((len(keep), len(channels), TREND_BINS), np.nan,
+                       dtype=np.float32)
+        for i, col in enumerate(columns):
+            if col is not None and col < num_channels:
+                data[:, i, :] = rows[keep, col, :]
+        all_times.append(times[keep])
+        all_rows.append(data)
+    if len(all_times) == 0:
+        return (np.zeros(0, dtype=np.int64), channels,
+                np.zeros((0, len(channels), TREND_BINS), dtype=np.float32))
+    times = np.concatenate(all_times)
+    data = np.concatenate(all_rows, axis=0)
+    # Later files (with more channels) take precedence for repeated times
+    order = np.argsort(times, kind='mergesort')[::-1]
+    times, first = np.unique(times[order], return_index=True)
+    return times, channels, data[order[first]]
+
+def get_spectra(data_files, channels):
+    """
+    Binned spectra from the per-channel data files saved by the jobs, as
+    a dict of channel: (freq_binned, psd_binned). Channels whose data
+    were flatlined have no spectrum and are left out.
+    """
+    
+    names = dict((c.replace(':', '_'), c) for c in channels)
+    spectra = {}
+    for filename in data_files:
+        channel_filename = os.path.basename(filename)[len('data_'):-4]
+        if channel_filename not in names:
+            continue
+        with np.load(filename) as data:
+            if 'psd_binned' in data.files:
+                spectra[names[channel_filename]] = (
+                    data['freq_binned'], data['psd_binned'])
+    return spectra
+
+def append_hour(trend_dir, gps, spectra):
+    """
+    Add one hour of binned spectra (a dict of channel: (freq_binned,
+    psd_binned)) to a trend archive, and update the averages of the day
+    and week containing it.
+    """
+    
+    if not os.path.isdir(trend_dir):
+        os.makedirs(trend_dir)
+    with file_lock(os.path.join(trend_dir, 'lock')):
+        channels, freqs = update_catalog(trend_dir, spectra)
+        row = np.full((len(channels), TREND_BINS), np.nan, dtype=np.float32)
+        for i, channel in enumerate(channels):
+            if channel in spectra:
+                psd = spectra[channel][1][:TREND_BINS]
+                row[i, :len(psd)] = psd
+        level_start = gps
+        for i, (level, span, file_span) in enumerate(TREND_LEVELS):
+            level_dir = os.path.join(trend_dir, level)
+            if i > 0:
+                # Average the rows of the previous level in this period
+                level_start = gps - gps % span
+                prev_level = TREND_LEVELS[i - 1][0]
+                times, _, rows = load_trend(
+                    trend_dir, prev_level, level_start, level_start + span,
+                    channels=channels)
+                if len(times) > 0:
+                    with warnings.catch_warnings():
+                        # Channels with no data in the period stay NaN
+                        warnings.simplefilter('ignore', RuntimeWarning)
+                        row = np.nanmean(rows, axis=0)
+            write_row(level_dir, file_span, level_start, row)
+
+def band_power(freqs, data, fmin, fmax):
+    """
+    Power in a frequency band for every row and channel of a loaded
+    trend, given the channels' binned frequencies (from read_catalog,
+    in the same channel order) and spectra of shape (times, channels,
+    TREND_BINS). Bins are weighted by their spacing.
+    """
+    
+    df = np.gradient(freqs, axis=1) if freqs.shape[1] > 1 else freqs
+    mask = (freqs >= fmin) & (freqs < fmax)
+    weights = np.where(mask, df, 0)
+    weights = np.where(np.isnan(weights), 0, weights)
+    return np.nansum(data * weights[np.newaxis], axis=2)
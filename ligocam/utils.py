@@ -17,26 +17,64 @@
 
 from __future__ import division
 import numpy as np
-import matplotlib.mlab as mlab
 import sys
 import os
 import re
+import time
 import shutil
 import fileinput
-from gwpy.time import from_gps
-from glue import lal
-from pylal import frutils
-from . import plot as lcplot
+import hashlib
+import tempfile
+from contextlib import contextmanager
+
+from . import (STARTUP_BUDGETS, ENVELOPE_POINTS, HISTORY_VERSION)
 
 __author__ = 'Dipongkar Talukder <dipongkar.talukder@ligo.org>'
 
 #================================================================
 
-def find_frame_files(cache_dir):
+def report_startup(script, start_time, budgets=STARTUP_BUDGETS):
+    """
+    Print the startup time of an entry point and warn if it exceeds
+    the script's startup budget.
+    """
+    
+    dt_startup = time.time() - start_time
+    sys.stdout.write("startup time %.3f\n" % dt_startup)
+    budget = budgets.get(script)
+    if budget is not None and dt_startup > budget:
+        sys.stderr.write(
+            "warning: %s startup took %.3f s (budget %.3f s)\n"
+            % (script, dt_startup, budget))
+    return dt_startup
+
+def get_option(config, section, option, default=None, type=str):
+    """
+    Get an optional config value, falling back to a default if it is
+    missing. Booleans accept yes/no, true/false, on/off and 1/0.
+    """
+    
+    if not config.has_option(section, option):
+        return default
+    value = config.get(section, option).strip()
+    if type is bool:
+        return value.lower() in ('1', 'yes', 'true', 'on')
+    return type(value)
+
+def find_frame_files(cache_dir, stager=None, index_dir=None, channels=None,
+                     validate_index=False):
     """
     Find frame cache files for current time and all reference times.
+    Only the current cache is parsed here; reference caches are returned
+    as LazyFrameCache handles, sorted from oldest to newest. If a
+    staging.FrameStager is given, frames are read from local copies. If
+    index_dir is given, channels are read through frame file indexes kept
+    there (see frameindex.IndexedFrameCache), and checked against the
+    frame library if validate_index.
     """
     
+    if index_dir is not None:
+        from .frameindex import IndexedFrameCache
     cache_files = os.listdir(cache_dir)
     frame_cache_refs = []
     for fname in cache_files:
@@ -44,31 +82,125 @@ def find_frame_files(cache_dir):
         current_match = re.findall('current', fname)
         ref_match = re.findall('reference-(\d+).txt', fname)
         if len(current_match) > 0:
-            with open(fullname, 'r') as cache:
-                cache_entries = [
-                    lal.CacheEntry(x.replace('\n', '')) \
-                    for x in cache.readlines()
-                ]
-            frame_cache_current = frutils.FrameCache(
-                cache_entries, scratchdir=None, verbose=False)
+            if index_dir is not None:
+                frame_cache_current = IndexedFrameCache(
+                    fullname, index_dir, channels, stager=stager,
+                    validate=validate_index)
+            else:
+                frame_cache_current = load_frame_cache(
+                    fullname, stager=stager)
         elif len(ref_match) > 0:
-            with open(fullname, 'r') as cache:
-                cache_entries = [
-                    lal.CacheEntry(x.replace('\n', '')) \
-                    for x in cache.readlines()
-                ]
-            frame_cache_ref = frutils.FrameCache(
-                cache_entries, scratchdir=None, verbose=False)
             ref_time = int(ref_match[0])
-            frame_cache_refs.append((ref_time, frame_cache_ref))
+            if index_dir is not None:
+                frame_cache = IndexedFrameCache(
+                    fullname, index_dir, channels, stager=stager,
+                    validate=validate_index)
+            else:
+                frame_cache = LazyFrameCache(fullname, stager=stager)
+            frame_cache_refs.append((ref_time, frame_cache))
+    frame_cache_refs.sort(key=lambda x: x[0])
     return frame_cache_current, frame_cache_refs
 
+def sieve_cache(cache, start, duration):
+    """
+    Select the entries of a frame cache that overlap [start, start+duration).
+    """
+    
+    from glue import segments
+    
+    return cache.sieve(segment=segments.segment(start, start + duration))
+
+def get_job_times(jobs_dir):
+    """
+    List the GPS times of jobs in a run's jobs directory that produced
+    any results, sorted. Jobs compacted by ligocam-prune are included.
+    """
+    
+    job_times = []
+    if not os.path.exists(jobs_dir):
+        return job_times
+    for fname in os.listdir(jobs_dir):
+        match = re.match(r'^(\d+)\.tar\.gz$', fname)
+        if match:
+            job_times.append(int(match.group(1)))
+            continue
+        if not fname.isdigit():
+            continue
+        results_dir = os.path.join(jobs_dir, fname, 'results')
+        if not os.path.isdir(results_dir):
+            continue
+        if any(x.startswith('result_') for x in os.listdir(results_dir)):
+            job_times.append(int(fname))
+    return sorted(job_times)
+
+def find_missing_times(jobs_dir, times, tolerance=1800):
+    """
+    Select the times that have no job with results within tolerance
+    seconds, e.g. hours missed while the cluster was down.
+    """
+    
+    job_times = np.array(get_job_times(jobs_dir))
+    missing = []
+    for t in times:
+        if len(job_times) == 0 or np.abs(job_times - t).min() > tolerance:
+            missing.append(t)
+    return missing
+
+def load_frame_cache(cache_file, stager=None):
+    """
+    Parse a frame cache file into a FrameCache, staging its frame files
+    locally if a stager is given.
+    """
+    
+    from glue import lal
+    from pylal import frutils
+    
+    with open(cache_file, 'r') as cache:
+        lines = [x.replace('\n', '') for x in cache.readlines()]
+    if stager is not None:
+        lines = [stager.stage_cache_line(x) for x in lines]
+    cache_entries = [lal.CacheEntry(x) for x in lines]
+    return frutils.FrameCache(cache_entries, scratchdir=None, verbose=False)
+
+class LazyFrameCache(object):
+    """
+    Handle to a frame cache file that is only parsed the first time data
+    is fetched from it. The parsed FrameCache is kept for later fetches.
+    """
+    
+    def __init__(self, cache_file, stager=None):
+        self.cache_file = cache_file
+        self.stager = stager
+        self._frame_cache = None
+    
+    @property
+    def frame_cache(self):
+        if self._frame_cache is None:
+            self._frame_cache = load_frame_cache(
+                self.cache_file, stager=self.stager)
+        return self._frame_cache
+    
+    def fetch(self, channel, start, end):
+        return self.frame_cache.fetch(channel, start, end)
+
 def get_data(frame_cache, channel, time, duration, overlap=0):
     """
     Fetch time series and PSD for a channel from frame cache.
     """
     
     ts = frame_cache.fetch(channel, time, time + duration)
+    psd, freq = compute_psd(ts, duration, overlap=overlap)
+    return ts, psd, freq
+
+def compute_psd(ts, duration, overlap=0, dtype=np.float64):
+    """
+    Compute the full-duration PSD of a time series, in single precision
+    if dtype is float32.
+    """
+    
+    if dtype == np.float32:
+        return compute_psd_single(ts, duration)
+    import matplotlib.mlab as mlab
     fs = len(ts) / duration
     psd, freq = mlab.psd(
         ts, NFFT=len(ts), Fs=int(fs), noverlap=int(overlap*fs),
@@ -76,25 +208,248 @@ def get_data(frame_cache, channel, time, duration, overlap=0):
         pad_to=None, sides='default', scale_by_freq=1
     )
     psd = psd.reshape(freq.shape)
-    return ts, psd, freq
+    return psd, freq
+
+def compute_psd_single(ts, duration):
+    """
+    Full-duration PSD of a time series computed in single precision, with
+    the same window and scaling as compute_psd. scipy.fft (scipy 1.4 and
+    later) transforms float32 data without converting it to float64.
+    """
+    
+    try:
+        from scipy.fft import rfft
+    except ImportError:  # older scipy; numpy transforms in float64
+        from numpy.fft import rfft
+    
+    x = np.asarray(ts, dtype=np.float32)
+    n = len(x)
+    fs = int(n / duration)
+    window = np.hanning(n).astype(np.float32)
+    xf = rfft(x * window)
+    psd = (xf.real ** 2 + xf.imag ** 2).astype(np.float32)
+    psd /= np.float32(fs * np.sum(window ** 2, dtype=np.float64))
+    # One-sided: double all but the DC and (for even n) Nyquist terms
+    psd[1:n - n // 2] *= 2
+    freq = (np.arange(len(psd)) * (float(fs) / n)).astype(np.float32)
+    return psd, freq
+
+def get_envelope(x, bin_size):
+    """
+    Compute the minimum and maximum of a time series in bins of a
+    fixed number of samples.
+    """
+    
+    n_bins = len(x) // bin_size
+    x_chunks = x[:bin_size * n_bins].reshape((-1, bin_size))
+    x_min = x_chunks.min(axis=1)
+    x_max = x_chunks.max(axis=1)
+    if len(x) > bin_size * n_bins:
+        x_edge = x[bin_size * n_bins:]
+        x_min = np.concatenate((x_min, [x_edge.min()]), axis=0)
+        x_max = np.concatenate((x_max, [x_edge.max()]), axis=0)
+    return x_min, x_max
+
+def reduce_timeseries(ts, duration, num_points=ENVELOPE_POINTS):
+    """
+    Reduce a time series to what is needed for plotting: a float32
+    min/max envelope of the full series plus the first and last second
+    of data. The size of the result does not depend on sample rate.
+    """
+    
+    ts = np.asarray(ts)
+    sample_rate = int(len(ts) // duration)
+    bin_size = max(1, int(np.ceil(len(ts) / num_points)))
+    env_min, env_max = get_envelope(ts, bin_size)
+    env_time = np.arange(len(env_min)) * bin_size / sample_rate
+    ts_reduced = {
+        'sample_rate': sample_rate,
+        'duration': duration,
+        'envelope_time': env_time.astype(np.float32),
+        'envelope_min': env_min.astype(np.float32),
+        'envelope_max': env_max.astype(np.float32),
+        'start': np.array(ts[:sample_rate + 1], dtype=np.float32),
+        'end': np.array(ts[-(sample_rate + 1):], dtype=np.float32)
+    }
+    return ts_reduced
+
+@contextmanager
+def atomic_open(filename, mode='w'):
+    """
+    Open a temporary file in the same directory as filename, which
+    replaces filename by an atomic rename only once the block completes
+    without error. Readers never see a partially written file.
+    """
+    
+    dirname = os.path.dirname(os.path.abspath(filename))
+    fd, temp_name = tempfile.mkstemp(
+        prefix='.%s.' % os.path.basename(filename), suffix='.tmp',
+        dir=dirname)
+    try:
+        if os.path.exists(filename):
+            os.chmod(temp_name, os.stat(filename).st_mode & 0o777)
+        else:
+            umask = os.umask(0)
+            os.umask(umask)
+            os.chmod(temp_name, 0o666 & ~umask)
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_name, filename)
+    except:
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+def atomic_copy(src, dst):
+    """
+    Copy a file so that dst is replaced atomically.
+    """
+    
+    with open(src, 'r') as f_in:
+        with atomic_open(dst) as f_out:
+            shutil.copyfileobj(f_in, f_out)
+
+def previous_generation(filename):
+    """
+    Name of the retained previous generation of a history file.
+    """
+    
+    return filename + '.prev'
+
+def write_history(filename, text, keep_previous=True, **fields):
+    """
+    Atomically write a history file with a version and checksum header.
+    Extra header fields can be given as keyword arguments. The file being
+    replaced is kept as the previous generation.
+    """
+    
+    checksum = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    header = '# ligocam version=%d sha1=%s' % (HISTORY_VERSION, checksum)
+    for key in sorted(fields.keys()):
+        header += ' %s=%s' % (key, fields[key])
+    with atomic_open(filename) as f:
+        f.write(header + '\n' + text)
+        if keep_previous and os.path.exists(filename):
+            prev = previous_generation(filename)
+            if os.path.exists(prev):
+                os.remove(prev)
+            try:
+                os.link(filename, prev)
+            except OSError:
+                shutil.copy2(filename, prev)
+
+def parse_history(content):
+    """
+    Validate the header of a history file. Returns the body and a dict of
+    header fields, or None if the file is corrupt. Files written before
+    headers were introduced are returned as they are.
+    """
+    
+    if len(content) == 0:
+        return None
+    if not content.startswith('# ligocam '):
+        return content, {}
+    if '\n' not in content:
+        return None
+    header, text = content.split('\n', 1)
+    fields = dict(
+        x.split('=', 1) for x in header.split()[2:] if '=' in x)
+    try:
+        version = int(fields.get('version', -1))
+    except ValueError:
+        return None
+    if version < 1 or version > HISTORY_VERSION:
+        return None
+    checksum = hashlib.sha1(text.encode('utf-8')).hexdigest()
+    if fields.get('sha1') != checksum:
+        return None
+    return text, fields
+
+def load_history(filename, parser=None):
+    """
+    Load a single generation of a history file, returning (value, fields)
+    or None if it is missing or corrupt. If given, parser converts the
+    text to a value and raises ValueError if the text is invalid.
+    """
+    
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'r') as f:
+        result = parse_history(f.read())
+    if result is None or parser is None:
+        return result
+    text, fields = result
+    try:
+        return parser(text), fields
+    except ValueError:
+        return None
+
+def read_history(filename, parser=None, previous=True):
+    """
+    Read and validate a history file. If it is missing or corrupt, the
+    previous generation is used instead and restored in its place.
+    Returns (value, fields), or None if no valid generation exists.
+    """
+    
+    result = load_history(filename, parser=parser)
+    if result is None and previous:
+        prev = previous_generation(filename)
+        result = load_history(prev, parser=parser)
+        if result is not None:
+            sys.stderr.write(
+                "warning: %s missing or corrupt, restoring %s\n"
+                % (filename, prev))
+            with open(prev, 'r') as f:
+                text, fields = parse_history(f.read())
+            fields = dict(
+                (k, v) for k, v in fields.items()
+                if k not in ('version', 'sha1'))
+            write_history(filename, text, keep_previous=False, **fields)
+    return result
+
+def get_fingerprint(items):
+    """
+    SHA-1 fingerprint of a list of arrays and strings, used to tell
+    whether the data behind a plot changed.
+    """
+    
+    sha1 = hashlib.sha1()
+    for x in items:
+        if isinstance(x, str):
+            sha1.update(x.encode('utf-8'))
+        else:
+            x = np.ascontiguousarray(x)
+            sha1.update(str(x.dtype).encode('utf-8'))
+            sha1.update(x.tobytes())
+    return sha1.hexdigest()
 
 def get_alert_hour(history_file, channel):
     """
     Add an hour to a channel's alert counter.
     """
     
-    with open(history_file, 'r') as file:
-        lines = [x.rstrip() for x in file.readlines()]
-    if len(lines) > 0:
-        channels, hours = zip(*[x.split(',') for x in lines])
-        if channel in channels:
-            idx = channels.index(channel)
-            hour = hours[idx]
-        else:
-            hour = 0
-    else:
-        hour = 0
-    return hour
+    history = read_history(history_file, parser=parse_alert_history)
+    if history is None:
+        return 0
+    return history[0].get(channel, 0)
+
+def parse_alert_history(text):
+    """
+    Parse a list of channel alert hours into floats, raising ValueError
+    if any line is malformed.
+    """
+    
+    hours = {}
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        split = line.rstrip().split(',')
+        if len(split) != 2:
+            raise ValueError("invalid alert history line: %s" % line)
+        hours[split[0]] = float(split[1])
+    return hours
 
 def get_binned(x, bin_size):
     """
@@ -183,6 +538,8 @@ def edit_calendar(calendar_file, results_url, current_gps):
     Add a results url link to calendar file.
     """
     
+    from gwpy.time import from_gps
+    
     ymdh = from_gps(current_gps).strftime('%Y%m%d%H')
     year= ymdh[:4]
     month = ymdh[4:6]
@@ -35,7 +35,11 @@ setup(
     scripts=[
         'bin/ligocam',
         'bin/ligocam-batch',
+        'bin/ligocam-live',
         'bin/ligocam-post',
+        'bin/ligocam-prune',
+        'bin/ligocam-render',
+        'bin/ligocam-reset',
         'bin/ligocam-setup'
     ]
 )